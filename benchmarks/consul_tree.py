@@ -0,0 +1,110 @@
+"""
+Benchmark building the consul: tag result for large key prefixes.
+
+The keys are served by a local stand-in for the consul KV api, run with:
+
+    python benchmarks/consul_tree.py [number of keys ...]
+"""
+import sys
+import json
+import base64
+import operator
+from functools import reduce
+from threading import Thread
+from time import perf_counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from e2j2.tags import consul_tag
+
+PREFIX = 'bench'
+
+
+def fixture(count):
+    return [
+        {
+            'Key': '{}/app{}/service{}/key{}'.format(PREFIX, idx % 100, idx // 100 % 100, idx),
+            'Value': base64.b64encode('value "{}"\nline 2'.format(idx).encode()).decode(),
+            'Flags': 0,
+            'CreateIndex': idx,
+            'ModifyIndex': idx,
+            'LockIndex': 0,
+        }
+        for idx in range(count)
+    ]
+
+
+def legacy_build_tree(kv_entries):
+    # json document per key, deep merged into the result (e2j2 <= 0.7.0)
+    from deepmerge import Merger
+
+    consul_merger = Merger([(list, ['append']), (dict, ['merge'])], ['override'], ['override'])
+    consul_dict = {}
+    for entry in kv_entries:
+        subkeys = entry['Key'].split('/')
+        value = entry['Value'].decode('utf-8') if hasattr(entry['Value'], 'decode') else entry['Value']
+        value = '' if value is None else value
+        value = value.replace('"', '\\"').replace('\n', '\\n')
+        key = '{"' + entry['Key'].replace('/', '":{"') + '": "' + value + '"}'.ljust(len(subkeys) + 1, '}')
+        consul_dict = consul_merger.merge(consul_dict, json.loads(key))
+    return consul_dict
+
+
+def serve(kv_entries):
+    body = json.dumps(kv_entries).encode()
+
+    class ConsulHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Consul-Index', str(len(kv_entries)))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), ConsulHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(func, *args):
+    started = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - started
+
+
+def main(counts):
+    try:
+        import deepmerge  # noqa: F401
+
+        legacy = True
+    except ImportError:
+        legacy = False
+
+    print('{:>8} {:>10} {:>12} {:>14} {:>12}'.format('keys', 'parse (s)', 'tree (s)', 'us per key', 'legacy (s)'))
+    for count in counts:
+        server = serve(fixture(count))
+        tag_config = {'url': 'http://127.0.0.1:{}'.format(server.server_port)}
+
+        result, parse_time = timed(consul_tag.parse, tag_config, PREFIX)
+        kv_entries = consul_tag.ConsulKV(tag_config).get(key=PREFIX, recurse=True)
+        tree, tree_time = timed(consul_tag.build_tree, kv_entries)
+        assert result == reduce(operator.getitem, [PREFIX], tree)
+
+        legacy_time = ''
+        if legacy:
+            legacy_tree, seconds = timed(legacy_build_tree, kv_entries)
+            assert legacy_tree == tree
+            legacy_time = '{:.3f}'.format(seconds)
+
+        print(
+            '{:>8} {:>10.3f} {:>12.3f} {:>14.2f} {:>12}'.format(
+                count, parse_time, tree_time, tree_time / count * 1000000, legacy_time
+            )
+        )
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,49 @@
+"""
+Benchmark validating tag configs with jsonschema.validate (e2j2 <= 0.7.0) and with the
+precompiled validators in e2j2.schemas, run with:
+
+    python benchmarks/validation.py [number of variables ...]
+"""
+import sys
+from time import perf_counter
+from jsonschema import validate, Draft4Validator
+from e2j2 import schemas
+from e2j2.constants import CONFIG_SCHEMAS
+
+TAG_CONFIGS = {
+    'vault:': {'url': 'https://vault.example.com:8200', 'backend': 'kv2', 'token': 'secret-token'},
+    'consul:': {'url': 'https://consul.example.com:8500', 'token': 'secret-token'},
+    'dns:': {'nameservers': ['127.0.0.1', '::1'], 'port': 53, 'type': 'SRV'},
+}
+
+
+def legacy_validate(tag, tag_config):
+    validate(instance=tag_config, schema=CONFIG_SCHEMAS[tag], format_checker=Draft4Validator.FORMAT_CHECKER)
+
+
+def timed(func, count, *args):
+    started = perf_counter()
+    for _ in range(count):
+        func(*args)
+    return perf_counter() - started
+
+
+def main(counts):
+    print('{:>10} {:>8} {:>18} {:>18} {:>10}'.format('variables', 'tag', 'validate (us/var)', 'compiled (us/var)', 'speedup'))
+    for count in counts:
+        for tag, tag_config in TAG_CONFIGS.items():
+            legacy_time = timed(legacy_validate, count, tag, tag_config)
+            compiled_time = timed(schemas.validate, count, tag, tag_config)
+            print(
+                '{:>10} {:>8} {:>18.2f} {:>18.2f} {:>9.1f}x'.format(
+                    count,
+                    tag,
+                    legacy_time / count * 1000000,
+                    compiled_time / count * 1000000,
+                    legacy_time / compiled_time,
+                )
+            )
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [100, 1000])
@@ -0,0 +1,47 @@
+import os
+from fnmatch import fnmatch
+from jinja2 import FileSystemBytecodeCache
+from e2j2.constants import J2_MARKERS
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory, max_size):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, "e2j2-%s.cache")
+        self.max_size = max_size
+
+    def get_bucket(self, environment, name, filename, source):
+        # the compiled code depends on the marker set, so include the markers in the cache key,
+        # changes in the template content are detected by the checksum of the source
+        markers = "|".join(getattr(environment, marker + "_string") for marker in J2_MARKERS)
+        return super().get_bucket(environment, name, "{}|{}".format(filename, markers), source)
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+
+        if bucket.code is not None:
+            # mark the entry as recently used
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if fnmatch(entry.name, self.pattern % "*"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # remove the least recently used entries until the cache fits in max_size
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            size -= entry_size
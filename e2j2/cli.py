@@ -5,18 +5,21 @@ import os
 import traceback
 import json
 import subprocess
+import tempfile
+import filecmp
 from random import uniform as random_uniform
 from subprocess import CalledProcessError
 from threading import Thread
 from time import sleep
-from jsonschema import validate, draft4_format_checker
 from os.path import basename
 from stat import ST_MODE
-from e2j2 import templates
+from e2j2 import schemas, tags, templates
+from e2j2.manifest import Manifest
+from e2j2.remote_cache import RemoteCache
 from e2j2.templates import get_vars
 from e2j2.constants import DESCRIPTION, VERSION
-from e2j2.constants import CONFIG_SCHEMAS
 from e2j2.exceptions import E2j2Exception
+from e2j2.watchers import Watchers
 from e2j2.display import (
     no_colors,
     write,
@@ -58,6 +61,21 @@ def arg_parse(program, description, version):
         action="store_true",
         help="Traverse recursively through the search list",
     )
+    arg_parser.add_argument(
+        "--exclude",
+        type=str,
+        help="Comma separated list of glob patterns for files and directories to skip while searching",
+    )
+    arg_parser.add_argument(
+        "--max-depth",
+        type=int,
+        help="Maximum directory depth when traversing recursively through the search list",
+    )
+    arg_parser.add_argument(
+        "--manifest",
+        type=str,
+        help="Index file of discovered templates, only changed directories are searched again",
+    )
     arg_parser.add_argument(
         "--no-color",
         "--nocolor",
@@ -187,6 +205,78 @@ def arg_parse(program, description, version):
         action="store_true",
         help="Initial run after e2j2 (re)start",
     )
+    arg_parser.add_argument(
+        "--bytecode-cache",
+        type=str,
+        help="Directory for caching compiled templates between runs (default: disabled)",
+    )
+    arg_parser.add_argument(
+        "--bytecode-cache-size",
+        type=int,
+        help="Maximum size of the bytecode cache in MB (default: 64)",
+    )
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of worker processes used for rendering templates (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--tag-concurrency",
+        type=int,
+        help="Maximum number of concurrent consul:, vault: and dns: lookups (default: 8)",
+    )
+    arg_parser.add_argument(
+        "--tag-timeout",
+        type=float,
+        help="Timeout in seconds for all consul:, vault: and dns: lookups together (default: no timeout)",
+    )
+    arg_parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Only resolve the tagged variables used by the templates (on first use when they can't be determined)",
+    )
+    arg_parser.add_argument(
+        "--tag-cache-ttl",
+        type=float,
+        help="Seconds resolved tag values are reused, limited by vault leases and dns TTLs (default: 0, disabled)",
+    )
+    arg_parser.add_argument(
+        "--tag-cache-size",
+        type=int,
+        help="Maximum number of cached tag values (default: 256)",
+    )
+    arg_parser.add_argument(
+        "--remote-cache",
+        type=str,
+        help="Encrypted cache file for consul:, vault: and dns: values, the key is read from E2J2_CACHE_KEY",
+    )
+    arg_parser.add_argument(
+        "--remote-cache-ttl",
+        type=float,
+        help="Seconds values in the remote cache are valid, limited by vault leases and dns TTLs (default: 300)",
+    )
+    arg_parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Show tag cache statistics",
+    )
+    arg_parser.add_argument(
+        "-U",
+        "--skip-unchanged",
+        action="store_true",
+        help="Don't write files with unchanged content, skip the run command when nothing changed",
+    )
+    arg_parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="Flush rendered files to disk before they replace the existing files",
+    )
+    arg_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the rendered output in chunks instead of rendering it in memory first (single pass only)",
+    )
     args = arg_parser.parse_args()
 
     if args.recursive and not args.searchlist and not "E2J2_SEARCHLIST" in os.environ:
@@ -198,6 +288,18 @@ def arg_parse(program, description, version):
     if args.initial_run and (not args.watchlist or not args.run):
         arg_parser.error("the following arguments are required: watchlist, run")
 
+    if args.jobs is not None and args.jobs < 1:
+        arg_parser.error("argument -j/--jobs: must be at least 1")
+
+    if args.tag_concurrency is not None and args.tag_concurrency < 1:
+        arg_parser.error("argument --tag-concurrency: must be at least 1")
+
+    if args.tag_cache_size is not None and args.tag_cache_size < 1:
+        arg_parser.error("argument --tag-cache-size: must be at least 1")
+
+    if args.max_depth is not None and args.max_depth < 0:
+        arg_parser.error("argument --max-depth: must be at least 0")
+
     return args
 
 
@@ -292,16 +394,65 @@ def configure(args):
     )
     config["splay"] = args.splay if args.watchlist else config.get("splay", 0)
     config["run"] = args.run if args.run else config.get("run", [])
+    config["bytecode_cache"] = (
+        args.bytecode_cache
+        if args.bytecode_cache
+        else config.get("bytecode_cache", None)
+    )
+    config["bytecode_cache_size"] = (
+        args.bytecode_cache_size
+        if args.bytecode_cache_size
+        else config.get("bytecode_cache_size", 64)
+    )
+    config["jobs"] = args.jobs if args.jobs else config.get("jobs", 1)
+    config["tag_concurrency"] = (
+        args.tag_concurrency
+        if args.tag_concurrency
+        else config.get("tag_concurrency", 8)
+    )
+    config["tag_timeout"] = (
+        args.tag_timeout if args.tag_timeout else config.get("tag_timeout", 0)
+    )
+    config["lazy"] = args.lazy if args.lazy else config.get("lazy", False)
+    config["tag_cache_ttl"] = (
+        args.tag_cache_ttl if args.tag_cache_ttl else config.get("tag_cache_ttl", 0)
+    )
+    config["tag_cache_size"] = (
+        args.tag_cache_size
+        if args.tag_cache_size
+        else config.get("tag_cache_size", 256)
+    )
+    config["remote_cache"] = (
+        args.remote_cache if args.remote_cache else config.get("remote_cache", None)
+    )
+    config["remote_cache_ttl"] = (
+        args.remote_cache_ttl
+        if args.remote_cache_ttl
+        else config.get("remote_cache_ttl", 300)
+    )
+    config["verbose"] = args.verbose if args.verbose else config.get("verbose", False)
+    config["skip_unchanged"] = (
+        args.skip_unchanged
+        if args.skip_unchanged
+        else config.get("skip_unchanged", False)
+    )
+    config["exclude"] = (
+        args.exclude.split(",") if args.exclude else config.get("exclude", [])
+    )
+    config["max_depth"] = (
+        args.max_depth if args.max_depth is not None else config.get("max_depth")
+    )
+    config["manifest"] = (
+        args.manifest if args.manifest else config.get("manifest", None)
+    )
+    config["fsync"] = args.fsync if args.fsync else config.get("fsync", False)
+    config["stream"] = args.stream if args.stream else config.get("stream", False)
     config["noop"] = args.noop
 
     if config["initial_run"] and (not config["watchlist"] or not config["run"]):
         raise E2j2Exception("the following arguments are required: watchlist, run")
 
-    validate(
-        instance=config,
-        schema=CONFIG_SCHEMAS["configfile"],
-        format_checker=draft4_format_checker,
-    )
+    schemas.validate("configfile", config)
 
     if config["no_color"]:
         no_colors()
@@ -313,13 +464,24 @@ def get_files(**kwargs):
     if kwargs["filelist"]:
         return kwargs["filelist"]
     else:
-        return templates.find(
+        find = kwargs["manifest"].find if kwargs.get("manifest") else templates.find
+        return find(
             searchlist=kwargs["searchlist"],
             j2file_ext=kwargs["extension"],
             recurse=kwargs["recurse"],
+            exclude=kwargs.get("exclude"),
+            max_depth=kwargs.get("max_depth"),
+            onerror=search_error,
         )
 
 
+def search_error(err):
+    colors = get_colors()
+    write(
+        f"{colors.yellow}** WARNING: skipping {err.filename}: {err.strerror} **{colors.reset}\n"
+    )
+
+
 def copy_file_permissions(source, destination):
     stat = os.stat(source)
 
@@ -330,83 +492,415 @@ def copy_file_permissions(source, destination):
     os.chmod(destination, int(perm, 8))
 
 
-def write_file(filename, content):
+def is_unchanged(filename, content):
+    try:
+        with open(filename, mode="r", newline="") as fh:
+            return fh.read() == content
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def is_same_file(tmpfile, filename):
+    try:
+        return filecmp.cmp(tmpfile, filename, shallow=False)
+    except OSError:
+        return False
+
+
+def copy_file_attributes(filename, tmpfile):
+    # keep the owner and permissions of the existing file, returns False when the owner can't
+    # be kept (changing the owner requires root)
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpfile, 0o666 & ~umask)
+        return True
+
+    tmpstat = os.stat(tmpfile)
+    if (stat.st_uid, stat.st_gid) != (tmpstat.st_uid, tmpstat.st_gid):
+        try:
+            os.chown(tmpfile, stat.st_uid, stat.st_gid)
+        except PermissionError:
+            return False
+    os.chmod(tmpfile, stat[ST_MODE] & 0o777)
+    return True
+
+
+def write_in_place(filename, content, fsync=False):
     with open(filename, mode="w") as fh:
-        fh.writelines(content)
+        if isinstance(content, str):
+            fh.write(content)
+        else:
+            fh.writelines(content)
+        if fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+
+
+def write_file(
+    filename, content, skip_unchanged=False, permissions=None, fsync=False
+):
+    # content is either a string or an iterable of chunks (streaming render)
+    streaming = not isinstance(content, str)
+    # symlinked outputs are written through the link, the target is replaced
+    filename = os.path.realpath(filename)
+    if skip_unchanged and not streaming and is_unchanged(filename, content):
+        return False
+
+    # write to a temporary file next to the destination and rename it, readers never see a partial file
+    try:
+        fd, tmpfile = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or ".", prefix=".%s." % basename(filename)
+        )
+    except PermissionError:
+        # the file can be writable in a directory which isn't (a prepared config file in a
+        # directory owned by root), the file is overwritten in place
+        write_in_place(filename, content, fsync)
+        if permissions:
+            copy_file_permissions(permissions, filename)
+        return True
+
+    try:
+        with open(fd, mode="w") as fh:
+            if streaming:
+                fh.writelines(content)
+            else:
+                fh.write(content)
+            if fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+
+        if skip_unchanged and streaming and is_same_file(tmpfile, filename):
+            os.unlink(tmpfile)
+            return False
+
+        if permissions:
+            copy_file_permissions(permissions, tmpfile)
+        elif not copy_file_attributes(filename, tmpfile):
+            # the file is owned by another user, overwrite it in place to keep the owner
+            with open(tmpfile, mode="r", newline="") as src:
+                write_in_place(filename, src, fsync)
+            os.unlink(tmpfile)
+            return True
+
+        os.replace(tmpfile, filename)
+    except BaseException:
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+        raise
+
+    return True
+
+
+def get_environments(config):
+    bytecode_cache = None
+    if config["bytecode_cache"]:
+        from e2j2.bytecode_cache import BytecodeCache
+
+        try:
+            bytecode_cache = BytecodeCache(
+                config["bytecode_cache"], config["bytecode_cache_size"] * 1024 * 1024
+            )
+        except OSError as err:
+            colors = get_colors()
+            write(
+                f"{colors.yellow}** WARNING: bytecode cache disabled: {str(err)} **{colors.reset}\n"
+            )
+
+    return templates.EnvironmentPool(bytecode_cache=bytecode_cache)
 
 
-def run(config):
+def process_template(config, j2file, j2vars, environments, content=None):
     colors = get_colors()
     exit_code = 0
-    search_list = config["searchlist"]
-    recursive = config["recursive"]
-    extension = config["extension"]
+    messages = []
+    rendered = None
+    changed = False
 
-    env_whitelist = config["env_whitelist"] if config["env_whitelist"] else os.environ
-    env_blacklist = config["env_blacklist"] if config["env_blacklist"] else []
-    j2vars = templates.get_vars(
-        config, whitelist=env_whitelist, blacklist=env_blacklist
-    )
-    old_directory = ""
+    try:
+        filename = re.sub(r"{}$".format(config["extension"]), "", j2file)
+        messages.append(
+            f"{'':3}{colors.green}rendering:{'':1}{colors.white}{basename(j2file):35}{'':1}{colors.green}=>{'':1}"
+        )
 
-    j2files = get_files(
-        filelist=config["filelist"],
-        searchlist=search_list,
-        extension=config["extension"],
-        recurse=recursive,
-    )
+        is_error = False
+        written = None
+        write_args = (
+            config["skip_unchanged"],
+            j2file if config["copy_file_permissions"] else None,
+            config["fsync"],
+        )
+
+        try:
+            if content is None and config["stream"] and not config["twopass"]:
+                chunks = templates.stream(config, j2file, j2vars, environments)
+                if config["noop"]:
+                    for _ in chunks:
+                        pass
+                else:
+                    written = write_file(filename, chunks, *write_args)
+            elif content is None:
+                content = templates.render(config, j2file, j2vars, environments)
+            status = f"{colors.green}success"
+        except Exception as err:
+            is_error = True
+            exit_code = 1
+            content = str(err)
+            filename += ".err"
+            status = f"{colors.green}content"
+
+            if config["stacktrace"]:
+                content += "\n\n%s" % traceback.format_exc()
+
+        if is_error and config["stderr"]:
+            messages.append(f"{colors.red}failed{colors.reset}{'':1}{content}\n")
+        else:
+            messages.append(
+                f"{status:7}{'':1}{colors.green}=> writing{'':1}{colors.white}{basename(filename):35}{'':1}{colors.green}=>{'':1}"
+            )
+
+            if config["noop"]:
+                messages.append(f"{colors.yellow}skipped{colors.reset}\n")
+                rendered = None if is_error else content
+            elif (
+                written
+                if written is not None
+                else write_file(filename, content, *write_args)
+            ):
+                changed = True
+                messages.append(f"{colors.green}success{colors.reset}\n")
+            else:
+                messages.append(f"{colors.green}unchanged{colors.reset}\n")
+
+    except Exception as err:
+        messages.append(f"{colors.red}failed{colors.reset}{'':1}({str(err)})\n")
+        exit_code = 1
+
+    return j2file, exit_code, messages, rendered, changed
+
+
+worker_state = None
+
+
+def init_worker(config, j2vars):
+    global worker_state
+
+    if config["no_color"]:
+        no_colors()
+
+    worker_state = (config, j2vars, get_environments(config))
+
+
+def process_template_worker(j2file, content):
+    config, j2vars, environments = worker_state
+    return process_template(config, j2file, j2vars, environments, content)
+
+
+def process_templates(config, j2files, j2vars, environments, rendered):
+    if config["jobs"] == 1:
+        for j2file in j2files:
+            yield process_template(
+                config, j2file, j2vars, environments, rendered.get(j2file)
+            )
+        return
+
+    # render and write the templates in worker processes, results are returned in order,
+    # lazy variables are resolved once in this process
+    from concurrent.futures import ProcessPoolExecutor
+
+    j2files = list(j2files)
+    contents = [rendered.get(j2file) for j2file in j2files]
+    chunksize = max(1, len(j2files) // (config["jobs"] * 4))
+    with ProcessPoolExecutor(
+        max_workers=config["jobs"],
+        initializer=init_worker,
+        initargs=(config, dict(j2vars)),
+    ) as executor:
+        yield from executor.map(
+            process_template_worker, j2files, contents, chunksize=chunksize
+        )
+
+
+def changed_vars(old_j2vars, j2vars):
+    return {
+        name
+        for name in set(old_j2vars) | set(j2vars)
+        if name not in old_j2vars
+        or name not in j2vars
+        or old_j2vars[name] != j2vars[name]
+    }
+
+
+def affected_templates(config, state, j2files, j2vars, environments):
+    # the dependencies are stored with the variables once the changes are applied
+    dependencies = state.get("dependencies", {})
+    pending = state["pending_dependencies"] = {}
+    changed = changed_vars(state["j2vars"], j2vars) if "j2vars" in state else None
 
     for j2file in j2files:
         try:
-            directory = os.path.dirname(j2file)
-            filename = re.sub(r"{}$".format(extension), "", j2file)
+            mtime = os.stat(j2file).st_mtime_ns
+        except OSError:
+            # let the render report the error
+            yield j2file
+            continue
 
-            if directory != old_directory:
+        if (
+            j2file not in dependencies
+            or dependencies[j2file][0] != mtime
+            or not all(uptodate() for uptodate in dependencies[j2file][2])
+        ):
+            # new or changed template or included template
+            uptodate = []
+            variables = templates.find_variables(config, j2file, environments, uptodate)
+            pending[j2file] = (mtime, variables, uptodate)
+            yield j2file
+        elif changed is None:
+            yield j2file
+        else:
+            variables = dependencies[j2file][1]
+            if variables is None or variables & changed:
+                yield j2file
+
+
+def run(config, state=None):
+    colors = get_colors()
+    exit_code = 0
+    rendered = {}
+    manifest = None
+
+    apply = state is not None and "rendered" in state and not config["noop"]
+
+    if apply:
+        # apply the output of the test run
+        j2vars = state["pending_j2vars"]
+        rendered = state["rendered"]
+        j2files = list(rendered)
+        manifest = state.pop("manifest", None)
+    else:
+        env_whitelist = (
+            config["env_whitelist"] if config["env_whitelist"] else os.environ
+        )
+        env_blacklist = config["env_blacklist"] if config["env_blacklist"] else []
+        templates.tag_cache.max_size = config["tag_cache_size"]
+        tags.timeout = config["tag_timeout"] or None
+        if config["remote_cache"] and templates.remote_cache is None:
+            try:
+                templates.remote_cache = RemoteCache(
+                    config["remote_cache"],
+                    os.environ.get("E2J2_CACHE_KEY"),
+                    config["remote_cache_ttl"],
+                )
+            except E2j2Exception as err:
                 write(
-                    f"\n{colors.green}In:{'':1}{colors.white}{directory}{colors.reset}\n"
+                    f"{colors.yellow}** WARNING: remote cache disabled: {str(err)} **{colors.reset}\n"
                 )
 
+        manifest = (
+            Manifest(config["manifest"], config)
+            if config["manifest"] and not config["filelist"]
+            else None
+        )
+        j2files = get_files(
+            filelist=config["filelist"],
+            searchlist=config["searchlist"],
+            extension=config["extension"],
+            recurse=config["recursive"],
+            exclude=config["exclude"],
+            max_depth=config["max_depth"],
+            manifest=manifest,
+        )
+
+    if state is None:
+        environments = get_environments(config)
+    else:
+        # keep the compiled templates between watch runs
+        if "environments" not in state:
+            state["environments"] = get_environments(config)
+        environments = state["environments"]
+
+    if not apply:
+        names = None
+        if config["lazy"]:
+            # only resolve the tagged variables used by the templates
+            j2files = list(j2files)
+            names = templates.referenced_variables(config, j2files, environments)
+
+        j2vars = templates.get_vars(
+            config,
+            whitelist=env_whitelist,
+            blacklist=env_blacklist,
+            names=names,
+            lazy=config["lazy"],
+        )
+
+    if state is not None:
+        if config["noop"]:
+            j2files = affected_templates(config, state, j2files, j2vars, environments)
+            state["pending_j2vars"] = j2vars
+            state["rendered"] = {}
+
+    bytecode_cache = environments.bytecode_cache
+    old_directory = ""
+
+    changed = False
+
+    for j2file, file_exit_code, messages, content, file_changed in process_templates(
+        config, j2files, j2vars, environments, rendered
+    ):
+        directory = os.path.dirname(j2file)
+
+        if directory != old_directory:
             write(
-                f"{'':3}{colors.green}rendering:{'':1}{colors.white}{basename(j2file):35}{'':1}{colors.green}=>{'':1}"
+                f"\n{colors.green}In:{'':1}{colors.white}{directory}{colors.reset}\n"
             )
+            old_directory = directory
 
-            is_error = False
+        for message in messages:
+            write(message)
 
-            try:
-                content = templates.render(config, j2file, j2vars)
-                status = f"{colors.green}success"
-            except Exception as err:
-                is_error = True
-                exit_code = 1
-                content = str(err)
-                filename += ".err"
-                status = f"{colors.green}content"
-
-                if config["stacktrace"]:
-                    content += "\n\n%s" % traceback.format_exc()
+        if state is not None and config["noop"] and file_exit_code == 0:
+            # streamed templates aren't kept in memory (content is None), the apply run
+            # streams them again
+            state["rendered"][j2file] = content
 
-            if is_error and config["stderr"]:
-                write(f"{colors.red}failed{colors.reset}{'':1}{content}\n")
-            else:
-                write(
-                    f"{status:7}{'':1}{colors.green}=> writing{'':1}{colors.white}{basename(filename):35}{'':1}{colors.green}=>{'':1}"
-                )
+        exit_code = exit_code or file_exit_code
+        changed = changed or file_changed
+        sys.stdout.flush()
 
-                if config["noop"]:
-                    write(f"{colors.yellow}skipped{colors.reset}\n")
-                else:
-                    write_file(filename, content)
+    if bytecode_cache:
+        bytecode_cache.prune()
 
-                    if config["copy_file_permissions"]:
-                        copy_file_permissions(j2file, filename)
+    if manifest and config["noop"]:
+        if state is not None:
+            # the search results of the test run are written by the apply run
+            state["manifest"] = manifest
+    elif manifest:
+        manifest.update()
+        try:
+            write_file(config["manifest"], manifest.dump(), skip_unchanged=True)
+        except OSError as err:
+            write(
+                f"{colors.yellow}** WARNING: writing manifest failed: {str(err)} **{colors.reset}\n"
+            )
 
-                    write(f"{colors.green}success{colors.reset}\n")
+    if templates.remote_cache is not None:
+        try:
+            templates.remote_cache.save()
+        except OSError as err:
+            write(
+                f"{colors.yellow}** WARNING: writing remote cache failed: {str(err)} **{colors.reset}\n"
+            )
 
-        except Exception as err:
-            write(f"{colors.red}failed{colors.reset}{'':1}({str(err)})\n")
-            exit_code = 1
-        finally:
-            sys.stdout.flush()
+    if config["verbose"] and config["tag_cache_ttl"]:
+        tag_cache = templates.tag_cache
+        write(
+            f"\n{colors.green}Tag cache:{colors.reset}{'':1}{tag_cache.hits} hits, {tag_cache.misses} misses, {len(tag_cache.entries)} entries\n"
+        )
 
     if config["noop"]:
         return exit_code
@@ -417,7 +911,9 @@ def run(config):
             f"\n{colors.green}Running:{colors.reset}\n{'':3}command:{'':1}{command}{'':1}{colors.green}=>"
         )
 
-        if exit_code == 0:
+        if exit_code == 0 and config["skip_unchanged"] and not changed:
+            write(f"{colors.yellow}{'':1}skipped (unchanged){colors.reset}\n")
+        elif exit_code == 0:
             try:
                 result = subprocess.check_output(
                     config["run"], stderr=subprocess.STDOUT
@@ -437,32 +933,53 @@ def run(config):
     return exit_code
 
 
-def watch_run(config):
+def watch_run(config, state=None):
     colors = get_colors()
     noop = config["noop"]
     config["noop"] = True
     write("Changes detected, testing templates:\n")
-    exit_code = run(config)
+    exit_code = run(config, state)
 
     if exit_code == 1:
         write(f"{colors.red}Test run failed, no changes applied${colors.reset}")
+        # the next watch run applies its changes again
+        config["noop"] = noop
+        if state is not None:
+            state.pop("rendered", None)
         return exit_code
 
     if noop:
+        if state is not None:
+            applied(state)
+            state.pop("rendered")
         return exit_code
 
     write("\nApplying changes:\n")
     config["noop"] = False
-    exit_code = run(config)
+    exit_code = run(config, state)
+
+    if state is not None:
+        # only templates affected by changes since the last applied run are rendered next time
+        if exit_code == 0:
+            applied(state)
+        state.pop("rendered")
     return exit_code
 
 
+def applied(state):
+    state["j2vars"] = state.pop("pending_j2vars")
+    state.setdefault("dependencies", {}).update(state.pop("pending_dependencies", {}))
+
+
 def watch(config):
     colors = get_colors()
     old_env_data = None
     first_run = True
     cfg = config.copy()
     cfg["run"] = []
+    watchers = Watchers(config, config["watchlist"])
+    state = {}
+    thread = None
 
     while True:
         try:
@@ -474,15 +991,26 @@ def watch(config):
             break
         if old_env_data == env_data:
             try:
-                sleep(random_uniform(1, config["splay"]) if config["splay"] else 1)
+                if watchers.wait(
+                    random_uniform(1, config["splay"]) if config["splay"] else 1
+                ):
+                    # resolve the notified value (and render the templates) without the cache
+                    templates.forget_cached_values()
+                if config["splay"] and not watchers.polling:
+                    # spread the load of watchers notified at the same time
+                    sleep(random_uniform(0, config["splay"]))
                 continue
             except KeyboardInterrupt:
                 break
 
+        if thread:
+            # the state of the previous run is needed to determine the affected templates
+            thread.join()
+
         if not config["initial_run"] and first_run:
-            thread = Thread(target=watch_run, args=(cfg,))
+            thread = Thread(target=watch_run, args=(cfg, state))
         else:
-            thread = Thread(target=watch_run, args=(config,))
+            thread = Thread(target=watch_run, args=(config, state))
         thread.start()
 
         old_env_data = env_data.copy()
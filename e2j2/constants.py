@@ -49,6 +49,23 @@ CONFIG_SCHEMAS = {
             "config_start": {"type": ["string", "null"]},
             "config_end": {"type": ["string", "null"]},
             "splay": {"type": "number", "minimum": 0, "maximum": 900},
+            "bytecode_cache": {"type": ["string", "null"]},
+            "bytecode_cache_size": {"type": "number", "minimum": 0},
+            "jobs": {"type": "integer", "minimum": 1},
+            "tag_concurrency": {"type": "integer", "minimum": 1},
+            "tag_timeout": {"type": "number", "minimum": 0},
+            "lazy": {"type": "boolean"},
+            "tag_cache_ttl": {"type": "number", "minimum": 0},
+            "tag_cache_size": {"type": "integer", "minimum": 1},
+            "remote_cache": {"type": ["string", "null"]},
+            "remote_cache_ttl": {"type": "number", "minimum": 0},
+            "verbose": {"type": "boolean"},
+            "skip_unchanged": {"type": "boolean"},
+            "fsync": {"type": "boolean"},
+            "manifest": {"type": ["string", "null"]},
+            "exclude": {"type": "array", "items": {"type": "string"}},
+            "max_depth": {"type": ["integer", "null"], "minimum": 0},
+            "stream": {"type": "boolean"},
         },
         "additionalProperties": False,
     },
@@ -109,6 +126,15 @@ TAGS = [
     "escape:",
 ]
 NESTED_TAGS = ["json:", "jsonfile:", "list:"]
+REMOTE_TAGS = ["consul:", "vault:", "dns:"]
+J2_MARKERS = [
+    "block_start",
+    "block_end",
+    "variable_start",
+    "variable_end",
+    "comment_start",
+    "comment_end",
+]
 MARKER_SETS = {
     "{{": {
         "block_start": "{%",
@@ -0,0 +1,112 @@
+import os
+import json
+from time import sleep, time
+from e2j2 import templates
+
+MANIFEST_VERSION = 2
+
+
+class Manifest:
+    def __init__(self, filename, config):
+        self.filename = filename
+        # the manifest is only valid for the same search settings
+        self.key = {
+            "searchlist": [os.path.realpath(path) for path in config["searchlist"]],
+            "extension": config["extension"],
+            "recursive": config["recursive"],
+            "exclude": config["exclude"],
+            "max_depth": config["max_depth"],
+        }
+        self.directories = {}
+        self.discovered = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return
+
+        if (
+            not isinstance(manifest, dict)
+            or manifest.get("version") != MANIFEST_VERSION
+            or manifest.get("key") != self.key
+        ):
+            return
+
+        self.directories = manifest.get("directories", {})
+
+    def find(
+        self, searchlist, j2file_ext, recurse=False, exclude=None, max_depth=None, onerror=None
+    ):
+        # only directories which changed since the last run are scanned
+        self.discovered = []
+        for j2file in templates.find(
+            searchlist,
+            j2file_ext,
+            recurse=recurse,
+            exclude=exclude,
+            max_depth=max_depth,
+            directories=self.directories,
+            onerror=onerror,
+        ):
+            self.discovered.append(j2file)
+            yield j2file
+
+    def update(self):
+        # writing the rendered files changes the mtime of their directories, these directories
+        # are scanned again now so the next run can skip them
+        changed = []
+        settled = 0
+        for directory in sorted({os.path.dirname(j2file) for j2file in self.discovered}):
+            entry = self.directories.get(directory)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+
+            if entry is not None and entry["mtime"] != mtime:
+                changed.append(directory)
+                if templates.mtime_window(mtime) == templates.RACY_MTIME_WINDOW_FINE:
+                    settled = max(settled, mtime / 1e9 + templates.RACY_MTIME_WINDOW_FINE)
+
+        # the files were just written, a scan within the timestamp granularity of the writes isn't
+        # trusted. The short wait for fine-grained timestamps saves the scans of the next run
+        if settled > time():
+            sleep(settled - time())
+
+        for directory in changed:
+            try:
+                stat = os.stat(directory)
+                j2files, subdirs = templates.scan_directory(
+                    directory, directory, self.key["extension"], self.key["exclude"] or []
+                )
+            except OSError:
+                continue
+            self.directories[directory] = templates.directory_entry(
+                stat, j2files, subdirs, time()
+            )
+
+        # forget directories which are no longer part of the search tree
+        reachable = {}
+        pending = list(self.key["searchlist"])
+        while pending:
+            directory = pending.pop()
+            if directory in self.directories and directory not in reachable:
+                reachable[directory] = self.directories[directory]
+                pending.extend(
+                    realpath for _, realpath in reachable[directory]["subdirs"]
+                )
+        self.directories = reachable
+
+    def dump(self):
+        return json.dumps(
+            {
+                "version": MANIFEST_VERSION,
+                "key": self.key,
+                "directories": self.directories,
+            },
+            indent=1,
+            sort_keys=True,
+        )
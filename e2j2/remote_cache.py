@@ -0,0 +1,147 @@
+import os
+import json
+import base64
+import hashlib
+import tempfile
+from copy import deepcopy
+from threading import Lock, Thread
+from time import time
+from e2j2.exceptions import E2j2Exception
+
+REFRESH_WORKERS = 4
+
+
+class RemoteCache:
+    def __init__(self, filename, secret, ttl=300):
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            raise E2j2Exception("the remote cache requires the cryptography package")
+
+        if not secret:
+            raise E2j2Exception("the remote cache requires a key in E2J2_CACHE_KEY")
+
+        # any secret can be used as key, fernet needs 32 url-safe base64-encoded bytes
+        self.fernet = Fernet(
+            base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest())
+        )
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = Lock()
+        self.refreshing = {}
+        self.dirty = False
+        # cleared when the values are known to be outdated (watch mode), new values are still
+        # written for the next start
+        self.serving = True
+        self.load()
+
+    @staticmethod
+    def key(tag, tag_config, value):
+        # the tag config can contain tokens, so only a digest is stored
+        return hashlib.sha256(
+            json.dumps([tag, tag_config, value], sort_keys=True).encode()
+        ).hexdigest()
+
+    def load(self):
+        from cryptography.fernet import InvalidToken
+
+        try:
+            with open(self.filename, "rb") as fh:
+                entries = json.loads(self.fernet.decrypt(fh.read()))
+        except (OSError, ValueError, InvalidToken):
+            return
+
+        now = time()
+        self.entries = {
+            key: entry for key, entry in entries.items() if entry["expires"] > now
+        }
+
+    def get(self, key, refresh):
+        with self.lock:
+            entry = self.entries.get(key)
+            now = time()
+            if not self.serving or entry is None or entry["expires"] <= now:
+                return False, None
+
+            if (
+                now >= entry["refresh"]
+                and key not in self.refreshing
+                and len(self.refreshing) < REFRESH_WORKERS
+            ):
+                # the entry is in the second half of its lifetime, fetch a new value in the
+                # background. The exit doesn't wait for the refresh, values which aren't refreshed
+                # when the cache is saved are refreshed by a later run
+                thread = Thread(target=self.refresh, args=(key, refresh), daemon=True)
+                self.refreshing[key] = thread
+                thread.start()
+
+            return True, deepcopy(entry["value"])
+
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return self.serving and entry is not None and entry["expires"] > time()
+
+    def refresh(self, key, refresh):
+        try:
+            value, ttl = refresh()
+            self.set(key, value, ttl)
+        except Exception:
+            # keep the cached value, it's fetched again when it expires
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+
+    def set(self, key, value, max_ttl=None):
+        # vault leases and dns records can expire before the configured ttl
+        ttl = min(self.ttl, max_ttl) if max_ttl is not None else self.ttl
+        if ttl <= 0:
+            return
+
+        now = time()
+        with self.lock:
+            self.entries[key] = {
+                "value": deepcopy(value),
+                "expires": now + ttl,
+                "refresh": now + ttl / 2,
+            }
+            self.dirty = True
+
+    def save(self, wait=False):
+        if wait:
+            # include the values which are refreshed in the background
+            with self.lock:
+                threads = list(self.refreshing.values())
+            for thread in threads:
+                thread.join()
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            now = time()
+            self.entries = {
+                key: entry
+                for key, entry in self.entries.items()
+                if entry["expires"] > now
+            }
+            token = self.fernet.encrypt(json.dumps(self.entries).encode())
+            self.dirty = False
+
+        # mkstemp creates the file readable by the owner only
+        fd, tmpfile = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename) or ".",
+            prefix=".%s." % os.path.basename(self.filename),
+        )
+        try:
+            with open(fd, "wb") as fh:
+                fh.write(token)
+            os.replace(tmpfile, self.filename)
+        except BaseException:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+            raise
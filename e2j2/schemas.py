@@ -0,0 +1,27 @@
+from e2j2.constants import CONFIG_SCHEMAS
+
+# jsonschema.validate checks the schema and creates a new validator on every call, the validators
+# are created once per schema and reused for every variable (and watch run)
+validators = {}
+
+
+def get_validator(name, schema=None):
+    if name not in validators:
+        from jsonschema import Draft4Validator
+        from jsonschema.validators import validator_for
+
+        schema = CONFIG_SCHEMAS[name] if schema is None else schema
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        format_checker = getattr(Draft4Validator, "FORMAT_CHECKER", None)
+        if format_checker is None:
+            # jsonschema < 4.5
+            from jsonschema import draft4_format_checker as format_checker
+
+        validators[name] = cls(schema, format_checker=format_checker)
+    return validators[name]
+
+
+def validate(name, instance, schema=None):
+    # raises jsonschema.ValidationError, schema is used for schemas which aren't in CONFIG_SCHEMAS
+    get_validator(name, schema).validate(instance)
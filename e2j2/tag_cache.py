@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from time import monotonic
+
+
+class TagCache:
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # callers modify the value (nested tags), so always hand out a copy
+                return True, deepcopy(entry[0])
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def contains(self, key):
+        # unlike get, the lookup isn't counted and the entry isn't marked as used
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] > monotonic()
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (deepcopy(value), monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            # evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def expire(self):
+        # unlike clear, the statistics are kept
+        with self.lock:
+            self.entries.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
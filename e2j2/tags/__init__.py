@@ -0,0 +1,84 @@
+import importlib
+from threading import Lock
+
+ENTRY_POINT_GROUP = "e2j2.tags"
+
+# timeout in seconds for vault: and dns: lookups (--tag-timeout), set by the cli
+timeout = None
+
+# the tag modules (and the libraries they depend on) are imported when the tag is first used,
+# the flag tells if the parse function takes the tag config
+BUILTIN_TAGS = {
+    "json:": ("e2j2.tags.json_tag", False),
+    "jsonfile:": ("e2j2.tags.jsonfile_tag", False),
+    "base64:": ("e2j2.tags.base64_tag", False),
+    "consul:": ("e2j2.tags.consul_tag", True),
+    "list:": ("e2j2.tags.list_tag", False),
+    "file:": ("e2j2.tags.file_tag", False),
+    "vault:": ("e2j2.tags.vault_tag", True),
+    "dns:": ("e2j2.tags.dns_tag", True),
+    "escape:": ("e2j2.tags.escape_tag", False),
+}
+
+# third-party tags, entry point name "foo" registers the tag "foo:", the entry point refers to
+# a module (or object) with a parse(tag_config, value) function
+plugins = None
+loaded_plugins = {}
+plugins_lock = Lock()
+
+
+def get_plugins():
+    global plugins
+
+    with plugins_lock:
+        if plugins is None:
+            found = {}
+            try:
+                from importlib.metadata import entry_points
+            except ImportError:
+                entry_points = None
+
+            if entry_points is not None:
+                try:
+                    eps = entry_points(group=ENTRY_POINT_GROUP)
+                except TypeError:
+                    # python < 3.10
+                    eps = entry_points().get(ENTRY_POINT_GROUP, [])
+
+                for entry_point in eps:
+                    tag = entry_point.name + ":"
+                    if tag not in BUILTIN_TAGS:
+                        found[tag] = entry_point
+            plugins = found
+
+        return plugins
+
+
+def looks_like_tag(tag):
+    # values like paths, urls or ports contain colons as well, reading the entry points takes
+    # tens of milliseconds
+    return tag[:-1].replace("-", "_").isidentifier()
+
+
+def is_tag(tag):
+    # the entry points are only read for names which can be plugin tags
+    return tag in BUILTIN_TAGS or (looks_like_tag(tag) and tag in get_plugins())
+
+
+def is_plugin(tag):
+    return tag not in BUILTIN_TAGS and looks_like_tag(tag) and tag in get_plugins()
+
+
+def takes_config(tag):
+    return BUILTIN_TAGS[tag][1] if tag in BUILTIN_TAGS else True
+
+
+def get_module(tag):
+    if tag in BUILTIN_TAGS:
+        return importlib.import_module(BUILTIN_TAGS[tag][0])
+
+    entry_point = get_plugins()[tag]
+    with plugins_lock:
+        if tag not in loaded_plugins:
+            loaded_plugins[tag] = entry_point.load()
+        return loaded_plugins[tag]
@@ -1,13 +1,19 @@
-import json
+import os
 import operator
 from consul import Consul
 from consul.base import ACLPermissionDenied
 from functools import reduce
-from deepmerge import Merger
+from threading import Lock
+from time import sleep
 from urllib.parse import urlparse
-from json.decoder import JSONDecodeError
 from e2j2.exceptions import E2j2Exception
 
+WATCH_RETRY_INTERVAL = 5
+
+# clients are shared by all lookups (and watch polls) using the same server and token
+clients = {}
+clients_lock = Lock()
+
 
 class ConsulKV:
     def __init__(self, config):
@@ -25,21 +31,63 @@ class ConsulKV:
         self.client = self.setup()
 
     def setup(self):
-        return Consul(scheme=self.scheme, host=self.host, port=self.port, token=self.token)
+        key = (self.scheme, self.host, self.port, self.token)
+        with clients_lock:
+            if key not in clients:
+                clients[key] = Consul(scheme=self.scheme, host=self.host, port=self.port, token=self.token)
+
+            return clients[key]
 
     def get(self, key, recurse=False):
         _, entries = self.client.kv.get(recurse=recurse, key=key)
         return entries
 
 
-def parse(tag_config, value):
+def prefetch(lookups):
+    # group the keys per server and top level folder, and fetch each group with one recursive read
+    groups = {}
+    for var, (tag_config, value) in lookups.items():
+        consul_kv = ConsulKV(config=tag_config)
+        consul_key = value.rstrip('/')
+        server = (consul_kv.scheme, consul_kv.host, consul_kv.port, consul_kv.token)
+        groups.setdefault((server, consul_key.split('/')[0]), []).append((var, consul_key, consul_kv))
+
+    prefetched = {}
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+
+        consul_keys = [consul_key for _, consul_key, _ in group]
+        folders = os.path.commonprefix([consul_key.split('/') for consul_key in consul_keys])
+        prefix = '/'.join(folders)
+        if prefix not in consul_keys and any(
+            consul_key.count('/') > len(folders) for consul_key in consul_keys
+        ):
+            # the prefix can hold much more than the keys, only sibling keys (or keys below a
+            # requested key) are fetched with one read
+            continue
+
+        try:
+            kv_entries = group[0][2].get(recurse=True, key=prefix if prefix in consul_keys else prefix + '/')
+        except Exception:
+            # fallback to a read per key, errors are reported per variable
+            continue
+
+        for var, consul_key, _ in group:
+            # slice the entries in the same way consul does for a recursive read of the key
+            prefetched[var] = [entry for entry in kv_entries or [] if entry['Key'].startswith(consul_key)]
+
+    return prefetched
+
+
+def parse(tag_config, value, kv_entries=None):
 
     consul_kv = ConsulKV(config=tag_config)
-    consul_merger = Merger([(list, ['append']), (dict, ['merge'])], ['override'], ['override'])
     consul_key = value.rstrip('/')
 
     try:
-        kv_entries = consul_kv.get(recurse=True, key=consul_key)
+        if kv_entries is None:
+            kv_entries = consul_kv.get(recurse=True, key=consul_key)
     except ACLPermissionDenied:
         raise E2j2Exception(
             'access denied connecting to: {}://{}:{} **'.format(consul_kv.scheme, consul_kv.host, consul_kv.port)
@@ -50,19 +98,49 @@ def parse(tag_config, value):
     if not kv_entries:
         # Mark as failed if we can't find the consul key
         raise E2j2Exception('key not found')
-    consul_dict = {}
+
     try:
-        for entry in kv_entries:
-            subkeys = entry['Key'].split('/')
-            value = entry['Value'].decode('utf-8') if hasattr(entry['Value'], 'decode') else entry['Value']
-            value = '' if value is None else value
-            value = value.replace('"', '\\"')  # escape double quotes
-            value = value.replace('\n', '\\n')  # escape newlines
-            if '/' in entry['Key']:
-                key = '{"' + entry['Key'].replace('/', '":{"') + '": "' + value + '"}'.ljust(len(subkeys) + 1, '}')
-                consul_dict = consul_merger.merge(consul_dict, json.loads(key))
-            else:
-                consul_dict[entry['Key']] = value
-        return reduce(operator.getitem, consul_key.split('/'), consul_dict)
-    except JSONDecodeError as err:
-        raise E2j2Exception(err)
+        return reduce(operator.getitem, consul_key.split('/'), build_tree(kv_entries))
+    except (KeyError, TypeError):
+        raise E2j2Exception('key not found')
+
+
+def watch(tag_config, value, changed, wait='5m'):
+    # blocking queries return as soon as the index of the key (prefix) changes
+    consul_kv = ConsulKV(config=tag_config)
+    consul_key = value.rstrip('/')
+    index = None
+
+    while True:
+        try:
+            new_index, _ = consul_kv.client.kv.get(consul_key, index=index, recurse=True, wait=wait)
+        except Exception:
+            # let the watch loop report the error, and retry later
+            changed.set()
+            sleep(WATCH_RETRY_INTERVAL)
+            index = None
+            continue
+
+        if index is not None and new_index != index:
+            changed.set()
+
+        index = new_index
+
+
+def build_tree(kv_entries):
+    consul_dict = {}
+    for entry in kv_entries:
+        value = entry['Value'].decode('utf-8') if hasattr(entry['Value'], 'decode') else entry['Value']
+        value = '' if value is None else value
+        *folders, key = entry['Key'].split('/')
+
+        node = consul_dict
+        for folder in folders:
+            # a folder replaces a value with the same name
+            if not isinstance(node.get(folder), dict):
+                node[folder] = {}
+            node = node[folder]
+
+        node[key] = value
+
+    return consul_dict
@@ -1,16 +1,43 @@
-from dns.resolver import Resolver, NoAnswer, NXDOMAIN, Timeout
+from threading import Lock
+from time import sleep, time
+from dns.resolver import Resolver, Cache, NoAnswer, NXDOMAIN, Timeout
+from e2j2 import tags
 from e2j2.exceptions import E2j2Exception
 
+WATCH_RETRY_INTERVAL = 5
+
+# one resolver (and answer cache) per nameservers and port, /etc/resolv.conf is read once and
+# answers are reused until their TTL expires
+resolvers = {}
+resolvers_lock = Lock()
+
+
+def get_resolver(tag_config):
+    key = (tuple(tag_config['nameservers']) if 'nameservers' in tag_config else None, tag_config.get('port'))
+    with resolvers_lock:
+        if key not in resolvers:
+            resolver = Resolver()
+            resolver.nameservers = tag_config['nameservers'] if 'nameservers' in tag_config else resolver.nameservers
+            resolver.port = tag_config['port'] if 'port' in tag_config else resolver.port
+            resolver.cache = Cache()
+            resolvers[key] = resolver
+        return resolvers[key]
+
 
 def parse(tag_config, value):
-    resolver = Resolver()
-    resolver.nameservers = tag_config['nameservers'] if 'nameservers' in tag_config else resolver.nameservers
-    resolver.port = tag_config['port'] if 'port' in tag_config else resolver.port
+    return parse_with_ttl(tag_config, value)[0]
+
+
+def parse_with_ttl(tag_config, value):
     rdtype = tag_config['type'] if 'type' in tag_config else 'A'
 
     try:
+        resolver = get_resolver(tag_config)
         return_values = []
-        replies = resolver.query(value, rdtype=rdtype)
+        replies = resolver.query(value, rdtype=rdtype, lifetime=tags.timeout)
+        # the remaining TTL, the answer can come from the cache
+        expiration = getattr(replies, 'expiration', None)
+        ttl = max(int(expiration - time()), 0) if expiration is not None else None
         for reply in replies:
             return_value = {}
 
@@ -34,4 +61,16 @@ def parse(tag_config, value):
     except Exception as err:
         raise E2j2Exception('dns_tag failed with: %s' % str(err))
 
-    return return_values
+    return return_values, ttl
+
+
+def watch(tag_config, value, changed):
+    # schedule a new check of the record when the TTL of the answer expires
+    while True:
+        try:
+            _, ttl = parse_with_ttl(tag_config, value)
+        except E2j2Exception:
+            ttl = None
+
+        sleep(max(ttl, 1) if ttl is not None else WATCH_RETRY_INTERVAL)
+        changed.set()
@@ -1,9 +1,15 @@
 import requests
+from threading import Lock
 from requests.exceptions import RequestException
 from urllib.parse import urlparse
 from e2j2.constants import VAULT_STATUSCODES
+from e2j2 import tags
 from e2j2.exceptions import E2j2Exception
 
+# sessions are shared by all lookups (and watch polls) using the same server and token
+sessions = {}
+sessions_lock = Lock()
+
 
 class Vault:
     def __init__(self, config):
@@ -19,22 +25,31 @@ class Vault:
         self.token = config['token'] if 'token' in config else None
         self.url = '%s://%s:%s/v1' % (self.scheme, self.host, self.port)
         self.session = self.setup()
+        self.lease_duration = None
 
     def setup(self):
-        session = requests.session()
-        session.headers.update({"Accept": "application/json"})
-        session.headers.update({"X-Vault-Token": self.token})
-        return session
+        key = (self.scheme, self.host, self.port, self.token)
+        with sessions_lock:
+            if key not in sessions:
+                session = requests.session()
+                session.headers.update({"Accept": "application/json"})
+                session.headers.update({"X-Vault-Token": self.token})
+                sessions[key] = session
+
+            return sessions[key]
 
     def get_raw(self, url):
         url = self.url + '/' + url
         try:
-            response = self.session.get(url)
+            response = self.session.get(url, timeout=tags.timeout)
         except RequestException:
             raise E2j2Exception('failed to connect to %s' % url)
 
         if response.status_code == 200:
-            return response.json()
+            data = response.json()
+            if isinstance(data, dict) and data.get('lease_duration'):
+                self.lease_duration = data['lease_duration']
+            return data
 
         if str(response.status_code) in VAULT_STATUSCODES:
             raise E2j2Exception(VAULT_STATUSCODES[str(response.status_code)])
@@ -61,13 +76,20 @@ class Vault:
 
 
 def parse(tag_config, value):
+    return parse_with_ttl(tag_config, value)[0]
+
+
+def parse_with_ttl(tag_config, value):
     vault = Vault(tag_config)
 
     if 'backend' not in tag_config or tag_config['backend'] == 'raw':
-        return vault.get_raw(value)
-    if tag_config['backend'] == 'kv1':
-        return vault.get_kv1(value)
+        data = vault.get_raw(value)
+    elif tag_config['backend'] == 'kv1':
+        data = vault.get_kv1(value)
     elif tag_config['backend'] == 'kv2':
-        return vault.get_kv2(value)
+        data = vault.get_kv2(value)
     else:
         raise E2j2Exception('Unknown K/V backend')
+
+    # the lease duration of the secret (if any) limits how long the value can be reused
+    return data, vault.lease_duration
@@ -1,34 +1,80 @@
 import os
+import hashlib
 import sys
-import jinja2
 import re
 import json
 import traceback
-from dpath import util as dpath_util
-from jinja2.exceptions import UndefinedError, FilterArgumentError, TemplateSyntaxError
-from jsonschema import validate, ValidationError, draft4_format_checker
+from collections import ChainMap
+from copy import deepcopy
+from time import monotonic, time
+from collections.abc import Mapping
+from fnmatch import fnmatch
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from queue import Queue, Empty
+from threading import Lock, Thread
 from json.decoder import JSONDecodeError
 from e2j2.exceptions import E2j2Exception
-from e2j2.constants import CONFIG_SCHEMAS, TAGS, NESTED_TAGS, MARKER_SETS
-from e2j2.tags import (
-    base64_tag,
-    consul_tag,
-    file_tag,
-    json_tag,
-    jsonfile_tag,
-    list_tag,
-    vault_tag,
-    dns_tag,
-    escape_tag,
+from e2j2.constants import (
+    CONFIG_SCHEMAS,
+    NESTED_TAGS,
+    REMOTE_TAGS,
+    MARKER_SETS,
+    J2_MARKERS,
 )
+from e2j2 import schemas, tags
+from e2j2.tags import file_tag
 from e2j2.display import write, get_colors
+from e2j2.tag_cache import TagCache
+from e2j2.remote_cache import RemoteCache
 
-try:
-    from jinja2_ansible_filters import AnsibleCoreFiltersExtension
+# jinja2, jsonschema, dpath and the tag backends are imported on first use, the optional
+# filter extension is loaded with the first environment
+j2_extensions = None
 
-    j2_extensions = [AnsibleCoreFiltersExtension]
-except ImportError:
-    j2_extensions = []
+# resolved tag values are shared by all variables (and watch runs) with the same tag, config and value
+tag_cache = TagCache()
+# encrypted on-disk cache of remote tag values, set up by the cli
+remote_cache = None
+# effective <TAG>_CONFIG / <TAG>_TOKEN config per tag and token files by path
+base_tag_configs = {}
+token_files = {}
+
+
+def get_extensions():
+    global j2_extensions
+
+    if j2_extensions is None:
+        try:
+            from jinja2_ansible_filters import AnsibleCoreFiltersExtension
+
+            j2_extensions = [AnsibleCoreFiltersExtension]
+        except ImportError:
+            j2_extensions = []
+    return j2_extensions
+
+
+class EnvironmentPool:
+    def __init__(self, bytecode_cache=None):
+        self.bytecode_cache = bytecode_cache
+        self.environments = {}
+
+    def get(self, markers, path):
+        # the environment (and its compiled template cache) is shared by all templates with
+        # the same search path and marker set
+        key = (path,) + tuple(markers[marker] for marker in J2_MARKERS)
+        if key not in self.environments:
+            import jinja2
+
+            self.environments[key] = jinja2.Environment(
+                loader=jinja2.FileSystemLoader([path or "./", "/"]),
+                undefined=jinja2.StrictUndefined,
+                keep_trailing_newline=True,
+                extensions=get_extensions(),
+                cache_size=-1,
+                bytecode_cache=self.bytecode_cache,
+                **{marker + "_string": markers[marker] for marker in J2_MARKERS}
+            )
+        return self.environments[key]
 
 
 def recursive_iter(obj, keys=()):
@@ -42,43 +88,328 @@ def recursive_iter(obj, keys=()):
         yield keys, obj
 
 
-def find(searchlist, j2file_ext, recurse=False):
-    if recurse:
-        return [
-            os.path.realpath(os.path.join(dirpath, j2file))
-            for searchlist_item in searchlist
-            for dirpath, dirnames, files in os.walk(searchlist_item, followlinks=True)
-            for j2file in files
-            if j2file.endswith(j2file_ext)
-        ]
-    else:
-        return [
-            os.path.realpath(os.path.join(searchlist_item, j2file))
-            for searchlist_item in searchlist
-            for j2file in os.listdir(searchlist_item)
-            if j2file.endswith(j2file_ext)
-        ]
+# a directory changed within the timestamp granularity of its scan can change again without a
+# new mtime, such directories are scanned again (whole seconds on NFS and FAT file systems)
+RACY_MTIME_WINDOW = 2.0
+RACY_MTIME_WINDOW_FINE = 0.02
+
+
+def mtime_window(mtime):
+    return RACY_MTIME_WINDOW if mtime % 1000000000 == 0 else RACY_MTIME_WINDOW_FINE
 
 
-def get_vars(config, whitelist, blacklist):
-    env_list = [entry for entry in whitelist if entry not in blacklist]
+def directory_entry(stat, j2files, subdirs, scanned):
+    mtime = stat.st_mtime_ns
+    return {
+        "mtime": mtime if scanned - mtime / 1e9 >= mtime_window(mtime) else None,
+        "templates": j2files,
+        "subdirs": subdirs,
+    }
+
+
+def find(
+    searchlist,
+    j2file_ext,
+    recurse=False,
+    exclude=None,
+    max_depth=None,
+    directories=None,
+    onerror=None,
+):
+    # templates are yielded while the search list is scanned, so rendering can start right away.
+    # Unreadable directories are skipped like os.walk does, onerror is called for search list items
+    max_depth = max_depth if recurse else 0
+    exclude = exclude or []
+    found = set()
+
+    for searchlist_item in searchlist:
+        visited = set()
+        pending = [(searchlist_item, os.path.realpath(searchlist_item), 0)]
+
+        while pending:
+            path, realpath, depth = pending.pop()
+            try:
+                stat = os.stat(path)
+                if (stat.st_dev, stat.st_ino) in visited:
+                    # symlink loop
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+                if (
+                    directories is not None
+                    and realpath in directories
+                    and directories[realpath]["mtime"] == stat.st_mtime_ns
+                ):
+                    # the directory entries didn't change since the last scan
+                    j2files = directories[realpath]["templates"]
+                    subdirs = directories[realpath]["subdirs"]
+                else:
+                    j2files, subdirs = scan_directory(
+                        path, realpath, j2file_ext, exclude
+                    )
+                    if directories is not None:
+                        directories[realpath] = directory_entry(
+                            stat, j2files, subdirs, time()
+                        )
+            except OSError as err:
+                if depth == 0 and onerror is not None:
+                    onerror(err)
+                continue
+
+            for j2file in j2files:
+                if j2file not in found:
+                    found.add(j2file)
+                    yield j2file
+
+            if max_depth is None or depth < max_depth:
+                for subdir, subdir_realpath in reversed(subdirs):
+                    pending.append((subdir, subdir_realpath, depth + 1))
+
+
+def scan_directory(path, realpath, j2file_ext, exclude):
+    j2files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if any(fnmatch(entry.name, pattern) for pattern in exclude):
+                continue
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+
+            if not is_dir and not entry.name.endswith(j2file_ext):
+                continue
+
+            # realpath is only resolved for symbolic links
+            entry_realpath = (
+                os.path.realpath(entry.path)
+                if entry.is_symlink()
+                else os.path.join(realpath, entry.name)
+            )
+
+            if is_dir:
+                subdirs.append([entry.path, entry_realpath])
+            else:
+                j2files.append(entry_realpath)
+
+    return j2files, subdirs
+
+
+def get_vars(config, whitelist, blacklist, names=None, lazy=False):
     env_vars = os.environ
+    env_list = [
+        entry
+        for entry in whitelist
+        if entry not in blacklist
+        and (names is None or entry in names or not is_lazy(env_vars.get(entry, "")))
+    ]
+    if lazy and names is None:
+        # the used variables are unknown, tagged variables are resolved on first lookup
+        return LazyVars(config, env_list, env_vars)
+    # the used tagged variables are resolved together (concurrently and prefetched)
     return resolv_vars(config, env_list, env_vars)
 
 
+class LazyVars(Mapping):
+    # tagged variables are resolved on first lookup, the others (and variables which can be
+    # flattened into the context) when the mapping is created
+    def __init__(self, config, var_list, env_vars):
+        self.config = config
+        self.env_vars = {var: env_vars[var] for var in var_list}
+        self.pending = dict.fromkeys(
+            var for var in var_list if is_lazy(self.env_vars[var])
+        )
+        self.resolved = resolv_vars(
+            config, [var for var in var_list if var not in self.pending], env_vars
+        )
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            # a failed lookup is reported once and the variable stays undefined
+            del self.pending[key]
+            self.resolved.update(resolv_vars(self.config, [key], self.env_vars))
+        return self.resolved[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def resolve_all(self):
+        for key in list(self.pending):
+            self.get(key)
+
+    def __iter__(self):
+        # failed variables are left out, so all variables are resolved first
+        self.resolve_all()
+        return iter(self.resolved)
+
+    def __len__(self):
+        self.resolve_all()
+        return len(self.resolved)
+
+
+def is_lazy(value):
+    # tagged variables are only resolved when they're referenced, unless their keys
+    # can be flattened into the context
+    tag = get_tag(value)
+    if not tag:
+        return False
+
+    config_var = tag.upper()[:-1] + "_CONFIG"
+    return tag not in CONFIG_SCHEMAS or not (
+        "flatten" in value or "flatten" in os.environ.get(config_var, "")
+    )
+
+
+def referenced_variables(config, j2files, environments):
+    names = set()
+    for j2file in j2files:
+        variables = find_variables(config, j2file, environments)
+        if variables is None:
+            # two pass rendering, dynamic includes or parse errors
+            return None
+        names.update(variables)
+    return names
+
+
+def get_tag(value):
+    # all tags are a name followed by a colon, so the text up to the first colon identifies the tag
+    name, colon, rest = value.partition(":")
+    tag = name + colon
+    if not colon:
+        return ""
+    # urls aren't plugin tags, only builtin tags are checked for them
+    if rest.startswith("//"):
+        return tag if tag in tags.BUILTIN_TAGS else ""
+    return tag if tags.is_tag(tag) else ""
+
+
+def prefetch_consul_keys(config, defined_tags, env_vars, deadline=None):
+    lookups = {}
+    for var, tag in defined_tags.items():
+        if tag == "consul:":
+            try:
+                tag_config, value = get_tag_config(config, tag, env_vars[var])
+            except E2j2Exception:
+                # the error is reported when the variable is resolved
+                continue
+
+            if not is_cached(config, tag, tag_config, value):
+                lookups[var] = (tag_config, value)
+
+    if len(lookups) < 2:
+        return {}
+
+    prefetch = tags.get_module("consul:").prefetch
+    if deadline is None:
+        return prefetch(lookups)
+
+    # a hung consul agent doesn't block the run, after half of the remaining time the keys are
+    # read one by one by the lookups instead
+    future = Future()
+    Thread(target=set_result, args=(future, prefetch, lookups), daemon=True).start()
+    try:
+        return future.result(timeout=max(deadline - monotonic(), 0) / 2)
+    except FutureTimeoutError:
+        return {}
+
+
+def is_cached(config, tag, tag_config, value):
+    # variables which are served from the tag cache or the remote cache aren't prefetched
+    if config.get("tag_cache_ttl", 0):
+        cache_key = tag_cache_key(tag, tag_config, value)
+        if cache_key and tag_cache.contains(cache_key):
+            return True
+
+    return (
+        remote_cache is not None
+        and tag in REMOTE_TAGS
+        and remote_cache.contains(RemoteCache.key(tag, tag_config, value))
+    )
+
+
+def start_lookups(config, defined_tags, env_vars, prefetched):
+    concurrency = config.get("tag_concurrency", 1)
+    timeout = config.get("tag_timeout", 0)
+    remote_vars = [var for var, tag in defined_tags.items() if tag in REMOTE_TAGS]
+
+    if not remote_vars or ((len(remote_vars) == 1 or concurrency < 2) and not timeout):
+        return {}
+
+    # resolve the remote tags in a bounded number of threads, the results are collected in
+    # resolv_vars. The threads are daemon threads (a ThreadPoolExecutor is joined at exit), so
+    # lookups which timed out don't keep e2j2 running
+    lookups = {var: Future() for var in remote_vars}
+    pending = Queue()
+    for var in remote_vars:
+        pending.put(var)
+
+    def worker():
+        while True:
+            try:
+                var = pending.get_nowait()
+            except Empty:
+                return
+
+            set_result(
+                lookups[var],
+                parse_tag,
+                config,
+                defined_tags[var],
+                env_vars[var],
+                prefetched.get(var),
+            )
+
+    for _ in range(min(concurrency, len(remote_vars))):
+        Thread(target=worker, daemon=True).start()
+    return lookups
+
+
+def set_result(future, func, *args):
+    future.set_running_or_notify_cancel()
+    try:
+        future.set_result(func(*args))
+    except BaseException as err:
+        future.set_exception(err)
+
+
 def resolv_vars(config, var_list, env_vars):
     colors = get_colors()
     varcontext = {}
+    defined_tags = {var: get_tag(env_vars[var]) for var in var_list}
+    timeout = config.get("tag_timeout", 0) or None
+    # the timeout applies to the prefetch and all lookups together, queued lookups count from
+    # the start as well
+    deadline = monotonic() + timeout if timeout else None
+    prefetched = prefetch_consul_keys(config, defined_tags, env_vars, deadline)
+    lookups = start_lookups(config, defined_tags, env_vars, prefetched)
+
     for var in var_list:
         var_value = env_vars[var]
-        defined_tag = "".join(
-            [tag for tag in TAGS if ":" in var_value and var_value.startswith(tag)]
-        )
+        defined_tag = defined_tags[var]
         try:
             if not defined_tag:
                 varcontext[var] = var_value
             else:
-                tag_config, tag_value = parse_tag(config, defined_tag, var_value)
+                if var in lookups:
+                    try:
+                        tag_config, tag_value = lookups[var].result(
+                            timeout=max(deadline - monotonic(), 0) if deadline else None
+                        )
+                    except FutureTimeoutError:
+                        raise E2j2Exception(
+                            "lookup timed out after %s seconds" % timeout
+                        )
+                else:
+                    tag_config, tag_value = parse_tag(
+                        config, defined_tag, var_value, prefetched.get(var)
+                    )
+
                 varcontext[var] = tag_value
 
                 if (
@@ -96,16 +427,50 @@ def resolv_vars(config, var_list, env_vars):
     return varcontext
 
 
-def parse_tag(config, tag, value):
+def get_base_tag_config(tag):
+    # the <TAG>_CONFIG and <TAG>_TOKEN env vars are parsed again when they change
+    config_var = tag.upper()[:-1] + "_CONFIG"
+    token_var = tag.upper()[:-1] + "_TOKEN"
+    key = (os.environ.get(config_var), os.environ.get(token_var))
+
+    base = base_tag_configs.get(tag)
+    if base is None or base["key"] != key:
+        tag_config = json.loads(key[0] if key[0] is not None else "{}")
+        if key[1] is not None and "token" not in tag_config:
+            tag_config["token"] = key[1]
+        # validated holds the token the config was last validated with
+        base = {"key": key, "config": tag_config, "validated": None}
+        base_tag_configs[tag] = base
+    return base
+
+
+def read_token_file(path):
+    # token files are read again when they change
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stamp = None
+
+    cached = token_files.get(path)
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    token = file_tag.parse(path).strip()
+    if stamp is not None:
+        token_files[path] = (stamp, token)
+    return token
+
+
+def get_tag_config(config, tag, value):
     tag_config = {}
-    value = re.sub(r"^{}".format(tag), "", value).strip()
-    if tag in CONFIG_SCHEMAS:
-        envvars = os.environ
-        config_var = tag.upper()[:-1] + "_CONFIG"
-        token_var = tag.upper()[:-1] + "_TOKEN"
+    value = (value[len(tag) :] if value.startswith(tag) else value).strip()
+    if tag in CONFIG_SCHEMAS or tags.is_plugin(tag):
+        overrides = False
         # FIXME be more specific on raising error (config or data)
         try:
-            tag_config = json.loads(envvars.get(config_var, "{}"))
+            base = get_base_tag_config(tag)
+            tag_config = deepcopy(base["config"])
             pattern = re.compile(r"config=(.+)")
             match = pattern.match(value)
 
@@ -120,58 +485,122 @@ def parse_tag(config, tag, value):
                 config_str, value = value_with_config
                 config_str = config_str.lstrip(markers["config_start"])
                 tag_config.update(json.loads("{%s}" % config_str))
+                overrides = True
             elif value_with_config:
                 raise E2j2Exception(
                     "invalid config markers used, please place the config between the markers '%s' and '%s'"
                     % (markers["config_start"], markers["config_end"])
                 )
 
-            if token_var in envvars:
-                tag_config["token"] = (
-                    tag_config["token"] if "token" in tag_config else envvars[token_var]
-                )
-
             if "token" in tag_config and tag_config["token"].startswith("file:"):
-                token_value = re.sub(r"^file:", "", tag_config["token"])
-                tag_config["token"] = file_tag.parse(token_value).strip()
+                tag_config["token"] = read_token_file(
+                    re.sub(r"^file:", "", tag_config["token"])
+                )
 
         except JSONDecodeError:
             raise E2j2Exception("decoding JSON failed")
 
+        # without overrides the config only changes with the env vars or the token
+        validated = (tag_config.get("token"),)
+        if overrides or base["validated"] != validated:
+            from jsonschema import ValidationError
+
+            try:
+                schemas.validate(
+                    tag,
+                    tag_config,
+                    None
+                    if tag in CONFIG_SCHEMAS
+                    else getattr(tags.get_module(tag), "CONFIG_SCHEMA", {"type": "object"}),
+                )
+            except ValidationError:
+                if config["stacktrace"]:
+                    write(traceback.format_exc())
+
+                raise E2j2Exception("config validation failed")
+
+            if not overrides:
+                base["validated"] = validated
+
+    return tag_config, value
+
+
+def forget_cached_values():
+    # a watcher notified a change, the cached values of the source can be outdated. The remote
+    # cache is only read until the first notification
+    tag_cache.expire()
+    if remote_cache is not None:
+        remote_cache.serving = False
+
+
+def tag_cache_key(tag, tag_config, value):
+    key = (tag, json.dumps(tag_config, sort_keys=True), value)
+    if tag in ["file:", "jsonfile:"]:
+        # a changed file invalidates the entry
         try:
-            validate(
-                instance=tag_config,
-                schema=CONFIG_SCHEMAS[tag],
-                format_checker=draft4_format_checker,
-            )
-        except ValidationError:
-            if config["stacktrace"]:
-                write(traceback.format_exc())
-
-            raise E2j2Exception("config validation failed")
-
-    if tag == "json:":
-        tag_value = json_tag.parse(value)
-    elif tag == "jsonfile:":
-        tag_value = jsonfile_tag.parse(value)
-    elif tag == "base64:":
-        tag_value = base64_tag.parse(value)
-    elif tag == "consul:":
-        tag_value = consul_tag.parse(tag_config, value)
-    elif tag == "list:":
-        tag_value = list_tag.parse(value)
-    elif tag == "file:":
-        tag_value = file_tag.parse(value)
-    elif tag == "vault:":
-        tag_value = vault_tag.parse(tag_config, value)
-    elif tag == "dns:":
-        tag_value = dns_tag.parse(tag_config, value)
-    elif tag == "escape:":
-        tag_value = escape_tag.parse(value)
-    else:
+            stat = os.stat(value)
+            key += (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    return key
+
+
+def limit_ttl(ttl, tag_ttl):
+    # vault leases and dns records can expire before the configured ttl
+    return min(ttl, tag_ttl) if tag_ttl is not None else ttl
+
+
+def resolve_tag(tag, tag_config, value, prefetched=None, with_ttl=False):
+    # returns the value and, when with_ttl is set, how long the value is valid (or None)
+    module = tags.get_module(tag)
+
+    if not tags.takes_config(tag):
+        return module.parse(value), None
+    if prefetched is not None:
+        return module.parse(tag_config, value, prefetched), None
+    if with_ttl and hasattr(module, "parse_with_ttl"):
+        return module.parse_with_ttl(tag_config, value)
+    return module.parse(tag_config, value), None
+
+
+def parse_tag(config, tag, value, prefetched=None):
+    tag_config, value = get_tag_config(config, tag, value)
+
+    if not tags.is_tag(tag):
         return None, "** ERROR: tag: %s not implemented **" % tag
 
+    cache_ttl = config.get("tag_cache_ttl", 0)
+    cache_key = tag_cache_key(tag, tag_config, value) if cache_ttl else None
+    cached, tag_value = tag_cache.get(cache_key) if cache_key else (False, None)
+
+    if not cached:
+        remote_key = (
+            RemoteCache.key(tag, tag_config, value)
+            if remote_cache is not None and tag in REMOTE_TAGS
+            else None
+        )
+        with_ttl = bool(cache_key or remote_key)
+        tag_ttl = None
+
+        if remote_key:
+            cached, tag_value = remote_cache.get(
+                remote_key, lambda: resolve_tag(tag, tag_config, value, with_ttl=True)
+            )
+
+        if not cached:
+            tag_value, tag_ttl = resolve_tag(
+                tag, tag_config, value, prefetched, with_ttl
+            )
+
+            if remote_key:
+                remote_cache.set(remote_key, tag_value, tag_ttl)
+
+        if cache_key:
+            tag_cache.set(cache_key, tag_value, limit_ttl(cache_ttl, tag_ttl))
+
     if config["nested_tags"] and tag in NESTED_TAGS:
+        from dpath import util as dpath_util
+
         try:
             for keys, item in recursive_iter(tag_value):
                 if isinstance(item, str):
@@ -186,93 +615,187 @@ def parse_tag(config, tag, value):
     return tag_config, tag_value
 
 
-def render(config, j2file, j2vars):
+def render(config, j2file, j2vars, environments=None):
     path, filename = os.path.split(j2file)
-    j2 = jinja2.Environment(
-        loader=jinja2.FileSystemLoader([path or "./", "/"]),
-        undefined=jinja2.StrictUndefined,
-        keep_trailing_newline=True,
-        extensions=j2_extensions,
-    )
+    environments = environments if environments else EnvironmentPool()
 
     try:
         with open(j2file, "r") as file:
             content = file.read()
 
         markers = detect_markers(config, content)
-        j2.block_start_string = markers["block_start"]
-        j2.block_end_string = markers["block_end"]
-        j2.variable_start_string = markers["variable_start"]
-        j2.variable_end_string = markers["variable_end"]
-        j2.comment_start_string = markers["comment_start"]
-        j2.comment_end_string = markers["comment_end"]
-        first_pass = j2.from_string(content).render(j2vars)
+        j2 = environments.get(markers, path)
+        first_pass = render_template(j2.get_template(filename), j2vars)
 
         if config["twopass"]:
             # second pass
             markers = detect_markers(config, first_pass)
-            j2.block_start_string = markers["block_start"]
-            j2.block_end_string = markers["block_end"]
-            j2.variable_start_string = markers["variable_start"]
-            j2.variable_end_string = markers["variable_end"]
-            j2.comment_start_string = markers["comment_start"]
-            j2.comment_end_string = markers["comment_end"]
-            return j2.from_string(first_pass).render(j2vars)
+            j2 = environments.get(markers, path)
+            return render_template(j2.from_string(first_pass), j2vars)
         else:
             return first_pass
-    except (UndefinedError, FilterArgumentError, TemplateSyntaxError) as err:
+    except Exception as err:
+        raise render_error(err, filename)
+
+
+def stream(config, j2file, j2vars, environments=None):
+    # single pass render, the output is yielded in chunks as it is generated
+    path, filename = os.path.split(j2file)
+    environments = environments if environments else EnvironmentPool()
+
+    try:
+        with open(j2file, "r") as file:
+            content = file.read()
+
+        j2 = environments.get(detect_markers(config, content), path)
+        yield from render_template(j2.get_template(filename), j2vars, stream=True)
+    except Exception as err:
+        raise render_error(err, filename)
+
+
+class LazyContext(ChainMap):
+    def copy(self):
+        # used for the locals of rewritten tracebacks, leave unresolved variables out
+        j2vars, template_globals = self.maps
+        return dict(template_globals, **j2vars.resolved)
+
+
+def render_template(template, j2vars, stream=False):
+    if not isinstance(j2vars, LazyVars):
+        return template.generate(j2vars) if stream else template.render(j2vars)
+
+    # render and generate copy the variables into a dict, a shared context keeps lookups lazy
+    context = template.new_context(LazyContext(j2vars, template.globals), shared=True)
+    if stream:
+        return generate_lazy(template, context)
+
+    try:
+        return template.environment.concat(template.root_render_func(context))
+    except Exception:
+        template.environment.handle_exception()
+
+
+def generate_lazy(template, context):
+    try:
+        yield from template.root_render_func(context)
+    except Exception:
+        yield template.environment.handle_exception()
+
+
+def render_error(err, filename):
+    from jinja2.exceptions import UndefinedError, FilterArgumentError, TemplateSyntaxError
+
+    if isinstance(err, (UndefinedError, FilterArgumentError, TemplateSyntaxError)):
         exc_type, exc_value, exc_tb = sys.exc_info()
         stacktrace = traceback.format_exception(exc_type, exc_value, exc_tb)
         match = re.search(r"\sline\s(\d+)", stacktrace[-2])
         content = "failed with error: {}".format(err)
         content += " at line: {}".format(match.group(1)) if match else ""
-        raise E2j2Exception(content)
-    except FileNotFoundError:
-        raise E2j2Exception("Template %s not found" % filename)
-    except Exception as err:
-        raise E2j2Exception(str(err))
+        return E2j2Exception(content)
+    elif isinstance(err, FileNotFoundError):
+        return E2j2Exception("Template %s not found" % filename)
+    else:
+        return E2j2Exception(str(err))
+
+
+def find_variables(config, j2file, environments, uptodate=None):
+    # the output of the first pass can reference any variable, the uptodate checks of the
+    # included templates are appended to uptodate
+    if config["twopass"]:
+        return None
+
+    from jinja2 import meta
+
+    path, filename = os.path.split(j2file)
+    variables = set()
+    try:
+        with open(j2file, "r") as file:
+            content = file.read()
+
+        # included templates are rendered with the environment of the template
+        j2 = environments.get(detect_markers(config, content), path)
+        pending = [(filename, content)]
+        seen = {filename}
+
+        while pending:
+            name, content = pending.pop()
+            ast = j2.parse(content)
+            variables.update(meta.find_undeclared_variables(ast))
+
+            for reference in meta.find_referenced_templates(ast):
+                if reference is None:
+                    # dynamic include
+                    return None
+
+                if reference not in seen:
+                    seen.add(reference)
+                    source, _, is_uptodate = j2.loader.get_source(j2, reference)
+                    if uptodate is not None and is_uptodate is not None:
+                        uptodate.append(is_uptodate)
+                    pending.append((reference, source))
+    except Exception:
+        # errors are reported when the template is rendered
+        return None
+
+    return variables
+
+
+MARKER_CONFIG_KEYS = [
+    "marker_set",
+    "autodetect_marker_set",
+    "block_start",
+    "block_end",
+    "variable_start",
+    "variable_end",
+    "comment_start",
+    "comment_end",
+    "config_start",
+    "config_end",
+]
+MARKERS_CACHE_SIZE = 1024
+markers_cache = {}
+# the markers are detected from the tag lookup threads as well
+markers_cache_lock = Lock()
+
+
+def autodetect_marker_set(content, default):
+    config_marker = "config=" in content
+    marker_set = default
+
+    # the last matching marker set wins
+    for key, value in MARKER_SETS.items():
+        if config_marker:
+            if "config=" + value["config_start"] in content:
+                marker_set = key
+        elif value["variable_start"] in content and value["variable_end"] in content:
+            marker_set = key
+    return marker_set
 
 
 def detect_markers(config, content):
-    marker_set = MARKER_SETS[config["marker_set"]]
-
-    if config["autodetect_marker_set"]:
-        config_marker = True if "config=" in content else False
-        for key, value in MARKER_SETS.items():
-            if config_marker:
-                if "config=" + MARKER_SETS[key]["config_start"] in content:
-                    marker_set = MARKER_SETS[key]
-            else:
-                if (
-                    MARKER_SETS[key]["variable_start"] in content
-                    and MARKER_SETS[key]["variable_end"] in content
-                ):
-                    marker_set = MARKER_SETS[key]
+    # the result is shared between callers with the same config and content, don't modify it
+    key = tuple(config[name] for name in MARKER_CONFIG_KEYS) + (
+        hashlib.sha1(content.encode("utf-8", "surrogatepass")).digest()
+        if config["autodetect_marker_set"]
+        else None,
+    )
+    markers = markers_cache.get(key)
+    if markers is not None:
+        return markers
+
+    marker_set = MARKER_SETS[
+        autodetect_marker_set(content, config["marker_set"])
+        if config["autodetect_marker_set"]
+        else config["marker_set"]
+    ]
 
     markers = {
-        "block_start": config["block_start"]
-        if config["block_start"]
-        else marker_set["block_start"],
-        "block_end": config["block_end"]
-        if config["block_end"]
-        else marker_set["block_end"],
-        "variable_start": config["variable_start"]
-        if config["variable_start"]
-        else marker_set["variable_start"],
-        "variable_end": config["variable_end"]
-        if config["variable_end"]
-        else marker_set["variable_end"],
-        "comment_start": config["comment_start"]
-        if config["comment_start"]
-        else marker_set["comment_start"],
-        "comment_end": config["comment_end"]
-        if config["comment_end"]
-        else marker_set["comment_end"],
-        "config_start": config["config_start"]
-        if config["config_start"]
-        else marker_set["config_start"],
-        "config_end": config["config_end"]
-        if config["config_end"]
-        else marker_set["config_end"],
+        marker: config[marker] if config[marker] else marker_set[marker]
+        for marker in MARKER_CONFIG_KEYS[2:]
     }
+
+    with markers_cache_lock:
+        if len(markers_cache) >= MARKERS_CACHE_SIZE:
+            markers_cache.clear()
+        markers_cache[key] = markers
     return markers
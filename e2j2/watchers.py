@@ -0,0 +1,97 @@
+import os
+from threading import Event, Thread
+from time import sleep
+from e2j2 import templates
+from e2j2.constants import NESTED_TAGS
+from e2j2.exceptions import E2j2Exception
+from e2j2 import tags
+
+try:
+    from inotify_simple import INotify, flags
+
+    inotify_flags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+except ImportError:
+    INotify = None
+
+FILE_POLL_INTERVAL = 1
+STATIC_TAGS = ["json:", "base64:", "list:", "escape:"]
+
+
+class Watchers:
+    def __init__(self, config, watchlist):
+        self.changed = Event()
+        self.polling = False
+        self.files = {}
+
+        for var in watchlist:
+            value = os.environ.get(var, "")
+            tag = templates.get_tag(value)
+
+            if config["nested_tags"] and tag in NESTED_TAGS:
+                # nested tags can point to any source
+                self.polling = True
+            elif tag in ["consul:", "dns:"]:
+                try:
+                    tag_config, tag_value = templates.get_tag_config(config, tag, value)
+                except E2j2Exception:
+                    self.polling = True
+                    continue
+
+                watch = tags.get_module(tag).watch
+                self.start(watch, tag_config, tag_value, self.changed)
+            elif tag in ["file:", "jsonfile:"]:
+                path = os.path.abspath(value[len(tag):].strip())
+                self.files.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+            elif tag and tag not in STATIC_TAGS:
+                # no change notification available (vault:)
+                self.polling = True
+
+            # plain values and static tags can't change during the lifetime of the process
+
+        if self.files:
+            self.start(self.watch_files_inotify if INotify else self.watch_files_stat)
+
+    @staticmethod
+    def start(target, *args):
+        Thread(target=target, args=args, daemon=True).start()
+
+    def watch_files_inotify(self):
+        inotify = INotify()
+        directories = {}
+        for directory, names in self.files.items():
+            try:
+                directories[inotify.add_watch(directory, inotify_flags)] = names
+            except OSError:
+                continue
+
+        while True:
+            for event in inotify.read():
+                # kubernetes replaces the files of a mounted configmap by swapping the ..data symlink
+                if event.name in directories.get(event.wd, ()) or event.name.startswith(".."):
+                    self.changed.set()
+
+    def watch_files_stat(self):
+        def file_stat(path):
+            try:
+                stat = os.stat(path)
+                return stat.st_ino, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                return None
+
+        paths = [os.path.join(directory, name) for directory, names in self.files.items() for name in names]
+        stats = {path: file_stat(path) for path in paths}
+
+        while True:
+            sleep(FILE_POLL_INTERVAL)
+            for path in paths:
+                stat = file_stat(path)
+                if stat != stats[path]:
+                    stats[path] = stat
+                    self.changed.set()
+
+    def wait(self, interval):
+        # wait for a change notification, sources without notifications are polled every interval.
+        # Returns True when a change was notified
+        notified = self.changed.wait(interval if self.polling else None)
+        self.changed.clear()
+        return notified
@@ -13,7 +13,6 @@ setup(
     install_requires=[
         'jinja2>=2.10.1',
         'python-consul>=0.6.0',
-        'deepmerge>=0.0.4',
         'dnspython',
         'jsonschema',
         'rfc3987',
@@ -0,0 +1,56 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from e2j2 import templates
+from e2j2.bytecode_cache import BytecodeCache
+from tests.test_templates import markers
+
+config = {'twopass': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+config.update(markers)
+
+
+class TestBytecodeCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_bytecode_cache(self):
+        with TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            j2file = os.path.join(tmpdir, 'file1.j2')
+            with open(j2file, 'w') as fh:
+                fh.write('{{ FOO }} (= FOO =)')
+
+            # compiled template is stored in the cache directory
+            bytecode_cache = BytecodeCache(cache_dir, 1024 * 1024)
+            environments = templates.EnvironmentPool(bytecode_cache=bytecode_cache)
+            self.assertEqual(templates.render(config, j2file, {'FOO': 'BAR'}, environments), 'BAR (= FOO =)')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # a new run loads the compiled template from the cache
+            environments = templates.EnvironmentPool(bytecode_cache=BytecodeCache(cache_dir, 1024 * 1024))
+            self.assertEqual(templates.render(config, j2file, {'FOO': 'BAZ'}, environments), 'BAZ (= FOO =)')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # other markers result in a separate cache entry
+            alternative_config = config.copy()
+            alternative_config.update({'variable_start': '(=', 'variable_end': '=)'})
+            self.assertEqual(templates.render(alternative_config, j2file, {'FOO': 'BAR'}, environments), '{{ FOO }} BAR')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # changed content is recompiled
+            with open(j2file, 'w') as fh:
+                fh.write('{{ FOO }}!')
+            environments = templates.EnvironmentPool(bytecode_cache=bytecode_cache)
+            self.assertEqual(templates.render(config, j2file, {'FOO': 'BAR'}, environments), 'BAR!')
+
+            # prune removes the least recently used entries
+            entries = sorted(os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir))
+            for age, entry in enumerate(entries):
+                os.utime(entry, (age, age))
+            bytecode_cache.max_size = os.path.getsize(entries[-1])
+            bytecode_cache.prune()
+            self.assertEqual([os.path.join(cache_dir, entry) for entry in os.listdir(cache_dir)], entries[-1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
+import os
+import re
+import sys
 import unittest
+from tempfile import TemporaryDirectory
 from mock import patch, mock_open
 from callee import Contains
-from subprocess import CalledProcessError
-from e2j2 import cli
+from subprocess import CalledProcessError, PIPE, run as run_process
+from e2j2 import cli, templates
 from e2j2.exceptions import E2j2Exception
 
+# heavy dependencies are imported on first use. The startup budget for importing the cli
+# (cumulative, in microseconds) depends on the machine, it's only checked when
+# E2J2_IMPORT_TIME_BUDGET is set
+IMPORT_TIME_BUDGET = os.environ.get('E2J2_IMPORT_TIME_BUDGET')
+LAZY_MODULES = ['jinja2', 'jinja2_ansible_filters', 'jsonschema', 'dpath', 'consul', 'dns', 'requests', 'cryptography']
+
 
 class ArgumentParser:
     def __init__(self):
@@ -35,6 +45,23 @@ class ArgumentParser:
         self.marker_set = '{{'
         self.autodetect_marker_set = False
         self.stderr = False
+        self.bytecode_cache = None
+        self.bytecode_cache_size = None
+        self.jobs = None
+        self.tag_concurrency = None
+        self.tag_timeout = None
+        self.skip_unchanged = False
+        self.fsync = False
+        self.stream = False
+        self.exclude = None
+        self.max_depth = None
+        self.manifest = None
+        self.lazy = False
+        self.tag_cache_ttl = None
+        self.tag_cache_size = None
+        self.remote_cache = None
+        self.remote_cache_ttl = None
+        self.verbose = False
 
 
 class TestCli(unittest.TestCase):
@@ -102,10 +129,105 @@ class TestCli(unittest.TestCase):
                 ['file1.j2', 'file2.j2'],
             )
 
+        # missing search list items are reported as a warning
+        with TemporaryDirectory() as tmpdir, patch('e2j2.cli.write') as write_mock:
+            missing = os.path.join(tmpdir, 'missing')
+            self.assertEqual(
+                list(cli.get_files(filelist=None, searchlist=[missing], extension='.j2', recurse=True)), []
+            )
+            write_mock.assert_called_once_with(Contains('WARNING: skipping %s' % missing))
+
     def test_write_file(self):
-        with patch('e2j2.cli.open', mock_open()) as open_mock:
-            cli.write_file('file.txt', 'content')
-            open_mock.assert_called_with('file.txt', mode='w')
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'file.txt')
+
+            # new files are created with the default permissions
+            umask = os.umask(0o022)
+            try:
+                self.assertTrue(cli.write_file(filename, 'content'))
+            finally:
+                os.umask(umask)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o644)
+            self.assertEqual(os.listdir(tmpdir), ['file.txt'])
+
+            # existing files are replaced, permissions are preserved
+            os.chmod(filename, 0o600)
+            inode = os.stat(filename).st_ino
+            with patch('e2j2.cli.os.fsync') as fsync_mock:
+                self.assertTrue(cli.write_file(filename, 'new content', fsync=True))
+                self.assertEqual(fsync_mock.call_count, 1)
+            self.assertNotEqual(os.stat(filename).st_ino, inode)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), 'new content')
+
+            # permissions copied from the template before the rename
+            with patch('e2j2.cli.copy_file_permissions') as permission_mock:
+                cli.write_file(filename, 'content', permissions='file.txt.j2')
+                source, destination = permission_mock.call_args[0]
+                self.assertEqual(source, 'file.txt.j2')
+                self.assertEqual(os.path.dirname(destination), tmpdir)
+                self.assertNotEqual(destination, filename)
+
+            # the temporary file is removed when writing fails, the destination is untouched
+            with patch('e2j2.cli.os.replace', side_effect=OSError('rename failed')):
+                with self.assertRaises(OSError):
+                    cli.write_file(filename, 'other content')
+            self.assertEqual(os.listdir(tmpdir), ['file.txt'])
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), 'content')
+
+            # skip unchanged content
+            self.assertTrue(cli.write_file(filename, 'content\r\n', skip_unchanged=True))
+            mtime = os.stat(filename).st_mtime_ns
+            os.utime(filename, ns=(mtime - 1000000, mtime - 1000000))
+
+            self.assertFalse(cli.write_file(filename, 'content\r\n', skip_unchanged=True))
+            self.assertEqual(os.stat(filename).st_mtime_ns, mtime - 1000000)
+
+            self.assertTrue(cli.write_file(filename, 'content\n', skip_unchanged=True))
+            self.assertTrue(cli.write_file(filename, 'content\n'))
+            with open(filename, newline='') as fh:
+                self.assertEqual(fh.read(), 'content\n')
+
+            # symlinks are written through, the link is kept
+            os.mkdir(os.path.join(tmpdir, 's'))
+            link = os.path.join(tmpdir, 's', 'link.txt')
+            os.symlink(filename, link)
+            self.assertTrue(cli.write_file(link, 'linked content'))
+            self.assertEqual(os.readlink(link), filename)
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), 'linked content')
+            self.assertEqual(os.listdir(os.path.join(tmpdir, 's')), ['link.txt'])
+
+            # the owner of the existing file is kept
+            stat = os.stat(filename)
+            with patch('e2j2.cli.os.chown') as chown_mock:
+                with patch('e2j2.cli.os.stat', side_effect=[
+                    os.stat_result((0o100600, 0, 0, 0, 1234, 1234) + tuple(stat[6:])), stat
+                ]):
+                    self.assertTrue(cli.write_file(filename, 'owned content'))
+                self.assertEqual(chown_mock.call_args[0][1:], (1234, 1234))
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+
+            # when the owner can't be changed the file is overwritten in place
+            inode = os.stat(filename).st_ino
+            with patch('e2j2.cli.os.chown', side_effect=PermissionError):
+                with patch('e2j2.cli.os.stat', side_effect=[
+                    os.stat_result((0o100600, 0, 0, 0, 1234, 1234) + tuple(stat[6:])), stat
+                ]):
+                    self.assertTrue(cli.write_file(filename, 'in place'))
+            self.assertEqual(os.stat(filename).st_ino, inode)
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), 'in place')
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['file.txt', 's'])
+
+            # the directory isn't writable, the file is overwritten in place
+            with patch('e2j2.cli.tempfile.mkstemp', side_effect=PermissionError(13, 'Permission denied')):
+                self.assertTrue(cli.write_file(filename, iter(['not ', 'writable'])))
+            self.assertEqual(os.stat(filename).st_ino, inode)
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), 'not writable')
 
     def test_copy_file_permissions(self):
         # assume that a file is owned by uid: 1000 and guid: 1000
@@ -152,20 +274,66 @@ class TestCli(unittest.TestCase):
             _ = cli.configure(args)
 
     def test_watch(self):
-        config = {'watchlist': ['foo'], 'no_color': True, 'splay': 0, 'run': [], 'initial_run': False}
+        config = {
+            'watchlist': ['foo'],
+            'no_color': True,
+            'splay': 0,
+            'run': [],
+            'initial_run': False,
+            'nested_tags': False,
+        }
         # with change
-        with patch('e2j2.cli.sleep', side_effect=KeyboardInterrupt):
+        with patch('e2j2.cli.Watchers') as watchers_mock:
+            watchers_mock.return_value.wait.side_effect = KeyboardInterrupt
             with patch('e2j2.cli.write') as display_mock:
                 with patch('e2j2.cli.get_vars', return_value={"FOO": "BAR"}):
                     with patch('e2j2.cli.Thread') as thread_mock:
                         cli.watch(config)
-                        thread_mock.assert_called_with(target=cli.watch_run, args=(config,))
+                        thread_mock.assert_called_with(target=cli.watch_run, args=(config, {}))
 
                 # key error raised
                 with patch('e2j2.cli.get_vars', side_effect=KeyError('FOO')):
                     cli.watch(config)
                     display_mock.assert_called_with(Contains("unknown key 'FOO'"))
 
+            watchers_mock.assert_called_with(config, ['foo'])
+            watchers_mock.return_value.wait.assert_called_with(1)
+
+            # splay after change notification
+            config['splay'] = 10
+            watchers_mock.return_value.wait.side_effect = None
+            watchers_mock.return_value.polling = False
+            with patch('e2j2.cli.get_vars', return_value={"FOO": "BAR"}):
+                with patch('e2j2.cli.Thread'):
+                    with patch('e2j2.cli.random_uniform', return_value=5):
+                        with patch('e2j2.cli.sleep', side_effect=KeyboardInterrupt) as sleep_mock:
+                            cli.watch(config)
+                            watchers_mock.return_value.wait.assert_called_with(5)
+                            sleep_mock.assert_called_with(5)
+
+    def test_watch_notified(self):
+        config = {
+            'watchlist': ['FOO'],
+            'no_color': True,
+            'splay': 0,
+            'run': [],
+            'initial_run': True,
+            'nested_tags': False,
+            'tag_cache_ttl': 60,
+        }
+        # notified changes aren't served from the tag cache
+        try:
+            with patch.dict('os.environ', {'FOO': 'base64:Zm9v'}):
+                with patch('e2j2.templates.resolve_tag', side_effect=[('v1', None), ('v2', None)]) as resolve_mock:
+                    with patch('e2j2.cli.Watchers') as watchers_mock:
+                        watchers_mock.return_value.wait.side_effect = [True, KeyboardInterrupt]
+                        with patch('e2j2.cli.Thread') as thread_mock:
+                            cli.watch(config)
+            self.assertEqual(resolve_mock.call_count, 2)
+            self.assertEqual(thread_mock.call_count, 2)
+        finally:
+            templates.tag_cache.clear()
+
     def test_watch_run(self):
         config = {'no_color': True, 'noop': False}
 
@@ -190,6 +358,138 @@ class TestCli(unittest.TestCase):
                 self.assertEqual(1, run_mock.call_count)
                 self.assertEqual(0, exit_code)
 
+    def test_watch_run_incremental(self):
+        args = ArgumentParser()
+        with TemporaryDirectory() as tmpdir:
+            args.searchlist = tmpdir
+            config = cli.configure(args)
+            for name in ['a', 'b']:
+                with open(os.path.join(tmpdir, name + '.j2'), 'w') as fh:
+                    fh.write('{{ %s }}' % name.upper())
+
+            state = {}
+            j2vars = [{'A': '1', 'B': '1'}, {'A': '2', 'B': '1'}, {'A': '2', 'B': '1', 'C': '1'}]
+            with patch('e2j2.cli.write'):
+                with patch('e2j2.templates.get_vars', side_effect=j2vars) as get_vars_mock:
+                    with patch('e2j2.templates.render', wraps=templates.render) as render_mock:
+                        with patch('e2j2.cli.write_file', wraps=cli.write_file) as write_mock:
+                            # first run renders all templates, the apply run reuses the test run output
+                            self.assertEqual(cli.watch_run(config, state), 0)
+                            self.assertEqual(get_vars_mock.call_count, 1)
+                            self.assertEqual(render_mock.call_count, 2)
+                            self.assertEqual(write_mock.call_count, 2)
+                            self.assertEqual(state['j2vars'], j2vars[0])
+
+                            # only the template using the changed variable is rendered
+                            render_mock.reset_mock()
+                            write_mock.reset_mock()
+                            self.assertEqual(cli.watch_run(config, state), 0)
+                            render_mock.assert_called_once_with(
+                                config, os.path.join(tmpdir, 'a.j2'), j2vars[1], state['environments']
+                            )
+                            write_mock.assert_called_once_with(os.path.join(tmpdir, 'a'), '2', False, None, False)
+
+                            # variable not used by any template
+                            render_mock.reset_mock()
+                            write_mock.reset_mock()
+                            self.assertEqual(cli.watch_run(config, state), 0)
+                            self.assertEqual(render_mock.call_count, 0)
+                            self.assertEqual(write_mock.call_count, 0)
+
+            with open(os.path.join(tmpdir, 'a')) as fh:
+                self.assertEqual(fh.read(), '2')
+
+    def test_watch_run_dependencies(self):
+        args = ArgumentParser()
+        with TemporaryDirectory() as tmpdir:
+            args.searchlist = tmpdir
+            config = cli.configure(args)
+
+            def write_template(name, content, mtime):
+                with open(os.path.join(tmpdir, name), 'w') as fh:
+                    fh.write(content)
+                os.utime(os.path.join(tmpdir, name), (mtime, mtime))
+
+            def read_output(name):
+                with open(os.path.join(tmpdir, name)) as fh:
+                    return fh.read()
+
+            write_template('a.j2', "{% include 'include.txt' %}{{ A }}", 1000)
+            write_template('include.txt', 'x', 1000)
+            write_template('b.j2', '{{ B }}', 1000)
+
+            state = {}
+            with patch('e2j2.cli.write'):
+                with patch('e2j2.templates.get_vars', return_value={'A': '1', 'B': '1'}):
+                    self.assertEqual(cli.watch_run(config, state), 0)
+                    self.assertEqual(read_output('a'), 'x1')
+
+                    # a changed include renders the template again
+                    write_template('include.txt', 'y', 2000)
+                    self.assertEqual(cli.watch_run(config, state), 0)
+                    self.assertEqual(read_output('a'), 'y1')
+
+                    # the changes of a failed test run are rendered again by the next run
+                    write_template('a.j2', "{% include 'include.txt' %}{{ A }}!", 2000)
+                    write_template('b.j2', '{{ B', 2000)
+                    self.assertEqual(cli.watch_run(config, state), 1)
+                    self.assertEqual(read_output('a'), 'y1')
+                    write_template('b.j2', '{{ B }}', 3000)
+                    self.assertEqual(cli.watch_run(config, state), 0)
+                    self.assertEqual(read_output('a'), 'y1!')
+
+    def test_manifest(self):
+        args = ArgumentParser()
+        with TemporaryDirectory() as tmpdir:
+            args.searchlist = os.path.join(tmpdir, 'templates')
+            args.manifest = os.path.join(tmpdir, 'manifest.json')
+            os.mkdir(args.searchlist)
+            with open(os.path.join(args.searchlist, 'a.j2'), 'w') as fh:
+                fh.write('{{ A }}')
+
+            with patch('e2j2.cli.write'):
+                with patch('e2j2.templates.get_vars', return_value={'A': '1'}):
+                    # nothing is written in noop mode
+                    args.noop = True
+                    self.assertEqual(cli.run(cli.configure(args)), 0)
+                    self.assertEqual(os.listdir(tmpdir), ['templates'])
+
+                    # the watch mode test run keeps the manifest for the apply run
+                    self.assertEqual(cli.watch_run(cli.configure(args), {}), 0)
+                    self.assertEqual(os.listdir(tmpdir), ['templates'])
+                    args.noop = False
+                    self.assertEqual(cli.watch_run(cli.configure(args), {}), 0)
+                    self.assertEqual(sorted(os.listdir(tmpdir)), ['manifest.json', 'templates'])
+
+    def test_watch_run_stream(self):
+        args = ArgumentParser()
+        args.stream = True
+        with TemporaryDirectory() as tmpdir:
+            args.searchlist = tmpdir
+            config = cli.configure(args)
+            with open(os.path.join(tmpdir, 'a.j2'), 'w') as fh:
+                fh.write('{{ A }}')
+
+            state = {}
+            with patch('e2j2.cli.write'):
+                with patch('e2j2.templates.get_vars', side_effect=[{'A': '1'}, {'A': '2'}, {}]):
+                    with patch('e2j2.templates.stream', wraps=templates.stream) as stream_mock:
+                        # streamed templates are rendered again when the test run is applied
+                        self.assertEqual(cli.watch_run(config, state), 0)
+                        self.assertEqual(stream_mock.call_count, 2)
+                        with open(os.path.join(tmpdir, 'a')) as fh:
+                            self.assertEqual(fh.read(), '1')
+
+                        self.assertEqual(cli.watch_run(config, state), 0)
+                        with open(os.path.join(tmpdir, 'a')) as fh:
+                            self.assertEqual(fh.read(), '2')
+
+                        # failed test run, nothing is applied
+                        self.assertEqual(cli.watch_run(config, state), 1)
+                        with open(os.path.join(tmpdir, 'a')) as fh:
+                            self.assertEqual(fh.read(), '2')
+                        self.assertFalse(os.path.exists(os.path.join(tmpdir, 'a.err')))
+
     def test_run(self):
         args = ArgumentParser()
         # FIXME replace all args.filelist.split with lists see normal run
@@ -215,7 +515,7 @@ class TestCli(unittest.TestCase):
                         with patch('e2j2.cli.write_file') as write_mock:
                             exit_code = cli.run(config)
                             self.assertEqual(exit_code, 0)
-                            write_mock.assert_called_with('/foo/file1', 'file1 content')
+                            write_mock.assert_called_with('/foo/file1', 'file1 content', False, None, False)
 
         # normal run with filelist flag set
         args.filelist = '/foo/file1.j2'
@@ -225,7 +525,7 @@ class TestCli(unittest.TestCase):
                 with patch('e2j2.cli.write_file') as write_mock:
                     exit_code = cli.run(config)
                     self.assertEqual(exit_code, 0)
-                    write_mock.assert_called_with('/foo/file1', 'file1 content')
+                    write_mock.assert_called_with('/foo/file1', 'file1 content', False, None, False)
         args.filelist = []
 
         # normal run with two files
@@ -262,8 +562,8 @@ class TestCli(unittest.TestCase):
                         with patch('e2j2.cli.write_file') as write_mock:
                             exit_code = cli.run(config)
                             self.assertEqual(exit_code, 1)
-                            write_mock.assert_called_with('/foo/file1.err', Contains('Error'))
-                            write_mock.assert_called_with('/foo/file1.err', Contains('Traceback'))
+                            write_mock.assert_called_with('/foo/file1.err', Contains('Error'), False, None, False)
+                            write_mock.assert_called_with('/foo/file1.err', Contains('Traceback'), False, None, False)
 
         # set permissions
         args.copy_file_permissions = True
@@ -272,10 +572,11 @@ class TestCli(unittest.TestCase):
             with patch('e2j2.cli.get_files', return_value=['/foo/file1.j2']):
                 with patch('e2j2.cli.os.path.dirname', side_effect=['foo']):
                     with patch('e2j2.templates.render', side_effect=['file1 content']):
-                        with patch('e2j2.cli.write_file'):
-                            with patch('e2j2.cli.copy_file_permissions') as permission_mock:
-                                cli.run(config)
-                                permission_mock.assert_called_with('/foo/file1.j2', '/foo/file1')
+                        with patch('e2j2.cli.write_file') as write_mock:
+                            cli.run(config)
+                            write_mock.assert_called_with(
+                                '/foo/file1', 'file1 content', False, '/foo/file1.j2', False
+                            )
         args.copy_file_permissions = False
 
         # run command
@@ -303,6 +604,24 @@ class TestCli(unittest.TestCase):
                                 exit_code = cli.run(config)
                                 self.assertEqual(exit_code, 1)
 
+        # run skipped when no files changed
+        args.skip_unchanged = True
+        config = cli.configure(args)
+        with patch('e2j2.cli.write') as display_mock:
+            with patch('e2j2.cli.get_files', return_value=['/foo/file1.j2']):
+                with patch('e2j2.cli.os.path.dirname', side_effect=['foo']):
+                    with patch('e2j2.templates.render', side_effect=['file1 content']):
+                        with patch('e2j2.cli.write_file', return_value=False) as write_mock:
+                            with patch('e2j2.cli.subprocess.check_output') as subprocess_mock:
+                                exit_code = cli.run(config)
+                                self.assertEqual(exit_code, 0)
+                                write_mock.assert_called_with('/foo/file1', 'file1 content', True, None, False)
+                                display_mock.assert_any_call('unchanged\n')
+                                display_mock.assert_called_with(' skipped (unchanged)\n')
+                                self.assertEqual(subprocess_mock.call_count, 0)
+        args.skip_unchanged = False
+        config = cli.configure(args)
+
         # run skipped due to rendering error
         with patch('e2j2.cli.write') as display_mock:
             with patch('e2j2.cli.get_files', return_value=['/foo/file1.j2']):
@@ -317,6 +636,86 @@ class TestCli(unittest.TestCase):
                                 display_mock.assert_called_with(Contains('skipped'))
         args.run = None
 
+    def test_process_templates(self):
+        args = ArgumentParser()
+        args.jobs = 2
+        config = cli.configure(args)
+
+        with TemporaryDirectory() as tmpdir:
+            j2files = []
+            for idx in range(5):
+                j2file = os.path.join(tmpdir, 'file%s.j2' % idx)
+                with open(j2file, 'w') as fh:
+                    fh.write('{{ FOO }} %s' % idx)
+                j2files.append(j2file)
+
+            # templates are rendered by the worker pool, results are returned in order
+            results = list(cli.process_templates(config, j2files, {'FOO': 'BAR'}, None, {}))
+            self.assertEqual([result[0] for result in results], j2files)
+            self.assertEqual([result[1] for result in results], [0, 0, 0, 0, 0])
+            self.assertEqual(results[0][2][-1], 'success\n')
+            for idx in range(5):
+                with open(os.path.join(tmpdir, 'file%s' % idx)) as fh:
+                    self.assertEqual(fh.read(), 'BAR %s' % idx)
+
+            # undefined variable
+            results = list(cli.process_templates(config, j2files[:2], {}, None, {}))
+            self.assertEqual([result[1] for result in results], [1, 1])
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'file0.err')))
+
+            # streaming render
+            args.jobs = 1
+            args.stream = True
+            args.skip_unchanged = True
+            config = cli.configure(args)
+            with patch('e2j2.templates.render') as render_mock:
+                results = list(cli.process_templates(config, j2files[:2], {'FOO': 'BAZ'}, None, {}))
+                self.assertEqual([result[1] for result in results], [0, 0])
+                self.assertEqual(results[0][2][-1], 'success\n')
+                self.assertEqual(render_mock.call_count, 0)
+                with open(os.path.join(tmpdir, 'file0')) as fh:
+                    self.assertEqual(fh.read(), 'BAZ 0')
+
+                results = list(cli.process_templates(config, j2files[:1], {'FOO': 'BAZ'}, None, {}))
+                self.assertEqual(results[0][2][-1], 'unchanged\n')
+                self.assertEqual(sorted(os.listdir(tmpdir))[:3], ['file0', 'file0.err', 'file0.j2'])
+
+                os.remove(os.path.join(tmpdir, 'file0.err'))
+                results = list(cli.process_templates(config, j2files[:1], {}, None, {}))
+                self.assertEqual(results[0][1], 1)
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'file0.err')))
+                with open(os.path.join(tmpdir, 'file0')) as fh:
+                    self.assertEqual(fh.read(), 'BAZ 0')
+
+    def test_lazy(self):
+        args = ArgumentParser()
+        args.lazy = True
+        with TemporaryDirectory() as tmpdir:
+            args.searchlist = tmpdir
+            config = cli.configure(args)
+            with open(os.path.join(tmpdir, 'file.j2'), 'w') as fh:
+                fh.write('{{ FOO }}')
+
+            env_vars = {'FOO': 'json:"bar"', 'SECRET': 'vault:secret/foo'}
+            with patch.dict('e2j2.templates.os.environ', env_vars, clear=True):
+                with patch('e2j2.cli.write'):
+                    with patch('e2j2.tags.vault_tag.parse') as vault_mock:
+                        self.assertEqual(cli.run(config), 0)
+                        self.assertEqual(vault_mock.call_count, 0)
+
+                        # variables used by a dynamic include can't be determined, but
+                        # tagged variables are still resolved on first use
+                        with open(os.path.join(tmpdir, 'include.j2'), 'w') as fh:
+                            fh.write('{{ FOO }}')
+                        with open(os.path.join(tmpdir, 'file.j2'), 'w') as fh:
+                            fh.write('{% include INCLUDE %}')
+                        with patch.dict('e2j2.templates.os.environ', {'INCLUDE': 'json:"include.j2"'}):
+                            self.assertEqual(cli.run(config), 0)
+                        self.assertEqual(vault_mock.call_count, 0)
+
+            with open(os.path.join(tmpdir, 'file')) as fh:
+                self.assertEqual(fh.read(), 'bar')
+
     def test_e2j2(self):
         args = ArgumentParser()
         args.stacktrace = True
@@ -344,6 +743,20 @@ class TestCli(unittest.TestCase):
                 cli.e2j2()
                 watch_mock.assert_called_once()
 
+    def test_import_time(self):
+        output = run_process(
+            [sys.executable, '-X', 'importtime', '-c', 'import e2j2.cli'], stderr=PIPE, check=True
+        ).stderr.decode()
+        imported = {}
+        for match in re.finditer(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', output):
+            imported[match.group(2)] = int(match.group(1))
+
+        self.assertIn('e2j2.cli', imported)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported)
+        if IMPORT_TIME_BUDGET:
+            self.assertLess(imported['e2j2.cli'], int(IMPORT_TIME_BUDGET))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+import os
+import json
+import unittest
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from types import SimpleNamespace
+from mock import patch
+from e2j2 import templates
+from e2j2.manifest import Manifest
+from tests.test_templates import markers
+
+config = {
+    'twopass': False,
+    'marker_set': '{{',
+    'autodetect_marker_set': False,
+    'extension': '.j2',
+    'recursive': True,
+    'exclude': [],
+    'max_depth': None,
+}
+config.update(markers)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_manifest(self):
+        with TemporaryDirectory() as tmpdir:
+            manifest_file = os.path.join(tmpdir, 'manifest.json')
+            tmpdir = os.path.join(os.path.realpath(tmpdir), 'tree')
+            config['searchlist'] = [tmpdir]
+            for path in ['a.j2', 'sub/b.j2', 'sub/deeper/c.j2']:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, path)), exist_ok=True)
+                with open(os.path.join(tmpdir, path), 'w') as fh:
+                    fh.write('{{ %s }}' % os.path.basename(path)[0].upper())
+
+            def discover(manifest):
+                return sorted(manifest.find(config['searchlist'], '.j2', recurse=True))
+
+            def save(manifest):
+                manifest.update()
+                with open(manifest_file, 'w') as fh:
+                    fh.write(manifest.dump())
+
+            # the directories were changed long before the scan
+            later = time() + 60
+            with patch('e2j2.templates.time', return_value=later), patch('e2j2.manifest.time', return_value=later):
+                # first run scans all directories
+                manifest = Manifest(manifest_file, config)
+                with patch('e2j2.templates.os.scandir', wraps=os.scandir) as scandir_mock:
+                    j2files = discover(manifest)
+                    self.assertEqual(scandir_mock.call_count, 3)
+                self.assertEqual(
+                    j2files, [os.path.join(tmpdir, path) for path in ['a.j2', 'sub/b.j2', 'sub/deeper/c.j2']]
+                )
+                save(manifest)
+
+                with open(manifest_file) as fh:
+                    data = json.load(fh)
+                self.assertEqual(data['version'], 2)
+                self.assertEqual(data['directories'][tmpdir]['templates'], [os.path.join(tmpdir, 'a.j2')])
+                self.assertEqual(data['directories'][tmpdir]['mtime'], os.stat(tmpdir).st_mtime_ns)
+
+                # unchanged tree, no directory is scanned
+                manifest = Manifest(manifest_file, config)
+                with patch('e2j2.templates.os.scandir', wraps=os.scandir) as scandir_mock:
+                    self.assertEqual(discover(manifest), j2files)
+                    self.assertEqual(scandir_mock.call_count, 0)
+
+                # directories with rendered output are scanned again when the manifest is updated
+                for path in ['a', 'sub/b']:
+                    with open(os.path.join(tmpdir, path), 'w') as fh:
+                        fh.write('output')
+                with patch('e2j2.templates.os.scandir', wraps=os.scandir) as scandir_mock:
+                    save(manifest)
+                    self.assertEqual(scandir_mock.call_count, 2)
+                    self.assertEqual(discover(Manifest(manifest_file, config)), j2files)
+                    self.assertEqual(scandir_mock.call_count, 2)
+
+                # only the changed directory is scanned
+                manifest = Manifest(manifest_file, config)
+                with open(os.path.join(tmpdir, 'sub', 'd.j2'), 'w') as fh:
+                    fh.write('{{ D }}')
+                with patch('e2j2.templates.os.scandir', wraps=os.scandir) as scandir_mock:
+                    self.assertIn(os.path.join(tmpdir, 'sub', 'd.j2'), discover(manifest))
+                    scandir_mock.assert_called_once_with(os.path.join(tmpdir, 'sub'))
+
+                # removed directories are dropped from the manifest
+                os.remove(os.path.join(tmpdir, 'sub', 'deeper', 'c.j2'))
+                os.rmdir(os.path.join(tmpdir, 'sub', 'deeper'))
+                self.assertNotIn(os.path.join(tmpdir, 'sub', 'deeper', 'c.j2'), discover(manifest))
+                save(manifest)
+                self.assertEqual(sorted(manifest.directories), [tmpdir, os.path.join(tmpdir, 'sub')])
+
+            # directories changed within the timestamp granularity of the scan are scanned again
+            for mtime, scanned, racy in [
+                (10 ** 18 + 5, 10 ** 9 + 0.01, True),
+                (10 ** 18 + 5, 10 ** 9 + 0.1, False),
+                # whole second timestamps
+                (10 ** 18, 10 ** 9 + 1, True),
+                (10 ** 18, 10 ** 9 + 2, False),
+            ]:
+                entry = templates.directory_entry(SimpleNamespace(st_mtime_ns=mtime), [], [], scanned)
+                self.assertEqual(entry['mtime'], None if racy else mtime)
+
+            with open(os.path.join(tmpdir, 'e.j2'), 'w') as fh:
+                fh.write('{{ E }}')
+            manifest = Manifest(manifest_file, config)
+            self.assertIn(os.path.join(tmpdir, 'e.j2'), discover(manifest))
+            self.assertIsNone(manifest.directories[tmpdir]['mtime'])
+            with patch('e2j2.templates.os.scandir', wraps=os.scandir) as scandir_mock:
+                discover(manifest)
+                scandir_mock.assert_called_once_with(tmpdir)
+
+            # the update waits for the timestamp granularity of the written output to pass
+            with open(os.path.join(tmpdir, 'e'), 'w') as fh:
+                fh.write('output')
+            if templates.mtime_window(os.stat(tmpdir).st_mtime_ns) == templates.RACY_MTIME_WINDOW_FINE:
+                with patch('e2j2.manifest.sleep', wraps=sleep) as sleep_mock:
+                    manifest.update()
+                    self.assertLessEqual(sleep_mock.call_args[0][0], templates.RACY_MTIME_WINDOW_FINE)
+                self.assertEqual(manifest.directories[tmpdir]['mtime'], os.stat(tmpdir).st_mtime_ns)
+
+            # different search settings invalidate the manifest
+            config['exclude'] = ['sub']
+            manifest = Manifest(manifest_file, config)
+            self.assertEqual(manifest.directories, {})
+            config['exclude'] = []
+
+            # invalid manifest
+            with open(manifest_file, 'w') as fh:
+                fh.write('invalid')
+            manifest = Manifest(manifest_file, config)
+            self.assertEqual(manifest.directories, {})
+            self.assertEqual(
+                discover(manifest), [os.path.join(tmpdir, path) for path in ['a.j2', 'e.j2', 'sub/b.j2', 'sub/d.j2']]
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
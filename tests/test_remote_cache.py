@@ -0,0 +1,134 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from threading import Event
+from mock import patch
+from e2j2 import templates
+from e2j2.exceptions import E2j2Exception
+from e2j2.remote_cache import RemoteCache
+from tests.test_templates import markers
+
+config = {'stacktrace': False, 'nested_tags': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+config.update(markers)
+
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_remote_cache(self):
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'cache')
+            key = RemoteCache.key('vault:', {'token': 'secret-token'}, 'secret/foo')
+
+            cache = RemoteCache(filename, 'cache key', 60)
+            self.assertEqual(cache.get(key, None), (False, None))
+            cache.set(key, {'password': 'secret-value'})
+            cache.set('no ttl', 'value', 0)
+            self.assertEqual(cache.entries[key]['refresh'] - cache.entries[key]['expires'], -30)
+            cache.save()
+
+            # the cache file is encrypted and only readable by the owner
+            with open(filename, 'rb') as fh:
+                content = fh.read()
+            self.assertNotIn(b'secret', content)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+            self.assertEqual(os.listdir(tmpdir), ['cache'])
+
+            # restart within the ttl
+            cache = RemoteCache(filename, 'cache key')
+            self.assertEqual(cache.get(key, None), (True, {'password': 'secret-value'}))
+            self.assertNotIn('no ttl', cache.entries)
+
+            # different key
+            self.assertEqual(RemoteCache(filename, 'other key').entries, {})
+
+            # values in the second half of their lifetime are refreshed in the background
+            refreshed = Event()
+
+            def refresh():
+                refreshed.set()
+                return {'password': 'new-value'}, None
+
+            expires = cache.entries[key]['expires']
+            with patch('e2j2.remote_cache.time', return_value=expires - 10):
+                self.assertEqual(cache.get(key, refresh), (True, {'password': 'secret-value'}))
+                cache.save(wait=True)
+            self.assertTrue(refreshed.is_set())
+            self.assertEqual(RemoteCache(filename, 'cache key').get(key, None), (True, {'password': 'new-value'}))
+
+            # failed refresh keeps the cached value
+            def failed_refresh():
+                raise E2j2Exception('connection failed')
+
+            expires = cache.entries[key]['expires']
+            with patch('e2j2.remote_cache.time', return_value=expires - 10):
+                cache.get(key, failed_refresh)
+                cache.save(wait=True)
+                self.assertEqual(cache.get(key, failed_refresh), (True, {'password': 'new-value'}))
+                cache.save(wait=True)
+
+            # saving the cache doesn't wait for the background refreshes
+            release = Event()
+
+            def slow_refresh():
+                release.wait(10)
+                return {'password': 'newer-value'}, None
+
+            with patch('e2j2.remote_cache.time', return_value=expires - 10):
+                cache.get(key, slow_refresh)
+                cache.save()
+                self.assertIn(key, cache.refreshing)
+                self.assertEqual(RemoteCache(filename, 'cache key').get(key, None), (True, {'password': 'new-value'}))
+                release.set()
+                cache.save(wait=True)
+                self.assertEqual(cache.refreshing, {})
+                self.assertEqual(cache.get(key, None), (True, {'password': 'newer-value'}))
+
+            # cached values
+            self.assertTrue(cache.contains(key))
+            self.assertFalse(cache.contains('unknown'))
+
+            # expired
+            expires = cache.entries[key]['expires']
+            with patch('e2j2.remote_cache.time', return_value=expires + 1):
+                self.assertEqual(cache.get(key, None), (False, None))
+
+            with self.assertRaisesRegex(E2j2Exception, 'E2J2_CACHE_KEY'):
+                RemoteCache(filename, None)
+
+    def test_parse_tag(self):
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'cache')
+            try:
+                templates.remote_cache = RemoteCache(filename, 'cache key')
+                with patch('e2j2.tags.vault_tag.parse_with_ttl', return_value=('secret', None)) as vault_mock:
+                    self.assertEqual(templates.parse_tag(config, 'vault:', 'secret/foo'), ({}, 'secret'))
+                    templates.remote_cache.save()
+
+                    # restart
+                    templates.remote_cache = RemoteCache(filename, 'cache key')
+                    self.assertEqual(templates.parse_tag(config, 'vault:', 'secret/foo'), ({}, 'secret'))
+                    self.assertEqual(vault_mock.call_count, 1)
+
+                    # after a change notification (watch mode) the values are fetched again
+                    vault_mock.return_value = ('changed', None)
+                    templates.forget_cached_values()
+                    self.assertFalse(templates.remote_cache.contains(RemoteCache.key('vault:', {}, 'secret/foo')))
+                    self.assertEqual(templates.parse_tag(config, 'vault:', 'secret/foo'), ({}, 'changed'))
+                    self.assertEqual(vault_mock.call_count, 2)
+                    self.assertEqual(
+                        templates.remote_cache.entries[RemoteCache.key('vault:', {}, 'secret/foo')]['value'], 'changed'
+                    )
+
+                # local tags are not cached
+                with patch('e2j2.tags.json_tag.parse', return_value={}) as json_mock:
+                    templates.parse_tag(config, 'json:', '{}')
+                    templates.parse_tag(config, 'json:', '{}')
+                    self.assertEqual(json_mock.call_count, 2)
+            finally:
+                templates.remote_cache = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from jsonschema import ValidationError, SchemaError
+from jsonschema.validators import validator_for
+from mock import patch
+from e2j2 import schemas
+from e2j2.constants import CONFIG_SCHEMAS
+
+
+class TestSchemas(unittest.TestCase):
+    def setUp(self):
+        schemas.validators.clear()
+
+    def test_validate(self):
+        # the validator is created (and the schema checked) once
+        cls = validator_for(CONFIG_SCHEMAS['dns:'])
+        with patch.object(cls, 'check_schema', wraps=cls.check_schema) as check_mock:
+            validator = schemas.get_validator('dns:')
+            schemas.validate('dns:', {'nameservers': ['127.0.0.1'], 'port': 53})
+            schemas.validate('dns:', {'type': 'SRV'})
+            self.assertIs(schemas.get_validator('dns:'), validator)
+            self.assertEqual(check_mock.call_count, 1)
+
+        # invalid config
+        with self.assertRaises(ValidationError):
+            schemas.validate('dns:', {'port': 65536})
+        with self.assertRaises(ValidationError):
+            schemas.validate('dns:', {'unknown': True})
+
+        # formats are checked
+        with self.assertRaises(ValidationError):
+            schemas.validate('dns:', {'nameservers': ['999.0.0.1']})
+
+        # schemas which aren't in CONFIG_SCHEMAS
+        schema = {'type': 'object', 'properties': {'url': {'type': 'string'}}}
+        schemas.validate('foo:', {'url': 'http://localhost'}, schema)
+        with self.assertRaises(ValidationError):
+            schemas.validate('foo:', {'url': 1}, schema)
+
+        with self.assertRaises(SchemaError):
+            schemas.validate('bar:', {}, {'type': 'invalid'})
+        self.assertNotIn('bar:', schemas.validators)
+
+    def tearDown(self):
+        schemas.validators.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
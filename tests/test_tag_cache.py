@@ -0,0 +1,49 @@
+import unittest
+from mock import patch
+from e2j2.tag_cache import TagCache
+
+
+class TestTagCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_tag_cache(self):
+        cache = TagCache(max_size=2)
+
+        # miss
+        self.assertEqual(cache.get('a'), (False, None))
+
+        # hit, the cached value is a copy
+        value = {'foo': ['bar']}
+        cache.set('a', value, 10)
+        value['foo'].append('baz')
+        found, cached = cache.get('a')
+        self.assertTrue(found)
+        self.assertEqual(cached, {'foo': ['bar']})
+        cached['foo'].append('baz')
+        self.assertEqual(cache.get('a'), (True, {'foo': ['bar']}))
+
+        # least recently used entry is evicted
+        cache.set('b', 'b', 10)
+        cache.get('a')
+        cache.set('c', 'c', 10)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+        # expired entries
+        with patch('e2j2.tag_cache.monotonic', return_value=10 ** 9):
+            self.assertEqual(cache.get('a'), (False, None))
+            self.assertNotIn('a', cache.entries)
+
+        # values without ttl are not cached
+        cache.set('d', 'd', 0)
+        self.assertNotIn('d', cache.entries)
+
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+        cache.expire()
+        self.assertEqual((cache.hits, cache.misses, len(cache.entries)), (3, 2, 0))
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, len(cache.entries)), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
+import socket
 import unittest
+import dns.message
+import dns.rrset
 import requests_mock
 from dns.resolver import Resolver, NXDOMAIN, Timeout
 from requests.exceptions import RequestException
-from mock import patch, mock_open, MagicMock
+from threading import Event, Thread
+from mock import patch, mock_open, MagicMock, call
 from consul.base import ACLPermissionDenied
 from e2j2.tags import base64_tag, consul_tag, file_tag, json_tag, jsonfile_tag, vault_tag, dns_tag, escape_tag
 from e2j2.tags import list_tag as list_tag
+from e2j2 import tags
 from e2j2.exceptions import E2j2Exception
 from json.decoder import JSONDecodeError
 
@@ -70,6 +75,11 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(consul_kv.port, 8500)
         self.assertEqual(consul_kv.token, None)
 
+        # clients are shared per server and token
+        self.assertIs(consul_kv.client, consul_tag.ConsulKV(config={}).client)
+        self.assertIsNot(consul_kv.client, consul_tag.ConsulKV(config={'token': 'aabbccddee'}).client)
+        self.assertIsNot(consul_kv.client, consul_tag.ConsulKV(config={'port': 8501}).client)
+
         # test get kv
         with patch.object(consul_kv.client.kv, 'get', return_value=(None, 'value')) as get_mock:
             consul_kv.get('foo/bar')
@@ -105,6 +115,100 @@ class TestParsers(unittest.TestCase):
         with patch('e2j2.tags.consul_tag.ConsulKV', return_value=consul_kv):
             self.assertEqual(consul_tag.parse(config, 'key'), 'foobar')
 
+    def test_consul_build_tree(self):
+        entries = [
+            {'Key': 'app', 'Value': b'replaced by folder'},
+            {'Key': 'app/', 'Value': None},
+            {'Key': 'app/db/host', 'Value': b'db.foo.bar'},
+            {'Key': 'app/db/query', 'Value': b'select "name"\nfrom table\\x'},
+            {'Key': 'top', 'Value': 'quoted "value"'},
+        ]
+        self.assertEqual(
+            consul_tag.build_tree(entries),
+            {
+                'app': {'': '', 'db': {'host': 'db.foo.bar', 'query': 'select "name"\nfrom table\\x'}},
+                'top': 'quoted "value"',
+            },
+        )
+
+        # key points to a folder that doesn't exist
+        with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=entries):
+            with self.assertRaisesRegex(E2j2Exception, 'key not found'):
+                consul_tag.parse({}, 'app/d')
+
+    def test_consul_prefetch(self):
+        entries = [
+            {'Key': 'app/cache/host', 'Value': b'cache.foo.bar'},
+            {'Key': 'app/db/host', 'Value': b'db.foo.bar'},
+            {'Key': 'app/db/port', 'Value': b'5432'},
+            {'Key': 'app/dbx/host', 'Value': b'dbx.foo.bar'},
+        ]
+        lookups = {
+            'DB': ({}, 'app/db'),
+            'CACHE': ({}, 'app/cache/'),
+            'OTHER': ({}, 'other/key'),
+            'REMOTE': ({'url': 'https://consul.foo.bar'}, 'app/db'),
+        }
+
+        # one recursive read for the keys sharing a prefix on the same server
+        with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=entries) as get_mock:
+            prefetched = consul_tag.prefetch(lookups)
+            get_mock.assert_called_once_with(recurse=True, key='app/')
+            self.assertEqual(prefetched, {'DB': entries[1:4], 'CACHE': entries[:1]})
+
+        # prefix is one of the keys
+        lookups = {'APP': ({}, 'app'), 'DB': ({}, 'app/db')}
+        with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=entries) as get_mock:
+            prefetched = consul_tag.prefetch(lookups)
+            get_mock.assert_called_once_with(recurse=True, key='app')
+            self.assertEqual(prefetched, {'APP': entries, 'DB': entries[1:4]})
+
+        # keys in different folders aren't fetched with a read of the whole parent folder
+        lookups = {'A': ({}, 'config/a/x'), 'B': ({}, 'config/b/y')}
+        with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=entries) as get_mock:
+            self.assertEqual(consul_tag.prefetch(lookups), {})
+            self.assertEqual(get_mock.call_count, 0)
+
+        # fallback to a read per key when the prefix read fails
+        lookups = {'APP': ({}, 'app'), 'DB': ({}, 'app/db')}
+        with patch('e2j2.tags.consul_tag.ConsulKV.get', side_effect=ACLPermissionDenied):
+            self.assertEqual(consul_tag.prefetch(lookups), {})
+
+        # parse the prefetched entries
+        with patch('e2j2.tags.consul_tag.ConsulKV.get') as get_mock:
+            self.assertEqual(consul_tag.parse({}, 'app/db', entries[1:4]), {'host': 'db.foo.bar', 'port': '5432'})
+            self.assertEqual(get_mock.call_count, 0)
+
+            with self.assertRaisesRegex(E2j2Exception, 'key not found'):
+                consul_tag.parse({}, 'app/queue', [])
+
+    def test_consul_watch(self):
+        changed = Event()
+        consul_kv = consul_tag.ConsulKV(config={})
+        responses = [(1, None), (1, None), (2, None), ACLPermissionDenied, (3, None), SystemExit]
+        with patch.object(consul_kv.client.kv, 'get', side_effect=responses) as get_mock:
+            with patch('e2j2.tags.consul_tag.sleep'):
+                with patch('e2j2.tags.consul_tag.ConsulKV', return_value=consul_kv):
+                    with self.assertRaises(SystemExit):
+                        consul_tag.watch({}, 'app/db/', changed)
+
+            # blocking query on the index returned by the previous query
+            get_mock.assert_any_call('app/db', index=None, recurse=True, wait='5m')
+            get_mock.assert_any_call('app/db', index=1, recurse=True, wait='5m')
+            get_mock.assert_any_call('app/db', index=2, recurse=True, wait='5m')
+            get_mock.assert_called_with('app/db', index=3, recurse=True, wait='5m')
+            self.assertTrue(changed.is_set())
+
+    def test_dns_watch(self):
+        changed = Event()
+        with patch('e2j2.tags.dns_tag.parse_with_ttl', side_effect=[([], 30), E2j2Exception('error')]):
+            with patch('e2j2.tags.dns_tag.sleep', side_effect=[None, SystemExit]) as sleep_mock:
+                with self.assertRaises(SystemExit):
+                    dns_tag.watch({}, 'www.foo.bar', changed)
+
+                self.assertEqual(sleep_mock.call_args_list, [call(30), call(dns_tag.WATCH_RETRY_INTERVAL)])
+                self.assertTrue(changed.is_set())
+
     def test_list(self):
         self.assertEqual(list_tag.parse('foo,bar'), ['foo', 'bar'])
         self.assertEqual(list_tag.parse('foo,  bar'), ['foo', 'bar'])
@@ -167,12 +271,24 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(vault.port, 8200)
         self.assertEqual(vault.token, None)
 
+        # sessions are shared per server and token
+        self.assertIs(vault.session, vault_tag.Vault(config={}).session)
+        self.assertIsNot(vault.session, vault_tag.Vault(config={'token': 'aabbccddee'}).session)
+        self.assertIsNot(vault.session, vault_tag.Vault(config={'url': 'https://localhost:8200'}).session)
+        self.assertEqual(vault_tag.Vault(config={'token': 'aabbccddee'}).session.headers['X-Vault-Token'], 'aabbccddee')
+
         # test get_raw
         vault = vault_tag.Vault(config={'url': 'https://localhost:8200'})
         with requests_mock.mock() as req_mock:
             req_mock.get('https://localhost:8200/v1/kv1/secret', json=raw_response_v1, status_code=200)
             response = vault.get_raw('kv1/secret')
             self.assertEqual(response, raw_response_v1)
+            self.assertIsNone(req_mock.last_request.timeout)
+
+            # --tag-timeout is used as request timeout
+            with patch('e2j2.tags.timeout', 2):
+                vault.get_raw('kv1/secret')
+                self.assertEqual(req_mock.last_request.timeout, 2)
 
         # not found
         with requests_mock.mock() as req_mock:
@@ -247,12 +363,22 @@ class TestParsers(unittest.TestCase):
             _ = vault_tag.parse(config, 'kv2/secret')
             vault_mock.assert_called_with('kv2/secret')
 
+        # lease duration of the secret
+        with requests_mock.mock() as req_mock:
+            req_mock.get('https://localhost:8200/v1/kv2/data/secret', json=raw_response_v2, status_code=200)
+            self.assertEqual(vault_tag.parse_with_ttl(config, 'kv2/secret'), ({'foo': 'bar'}, None))
+        config = {'url': 'https://localhost:8200', 'backend': 'kv1'}
+        with requests_mock.mock() as req_mock:
+            req_mock.get('https://localhost:8200/v1/kv1/secret', json=raw_response_v1, status_code=200)
+            self.assertEqual(vault_tag.parse_with_ttl(config, 'kv1/secret'), ({'foo': 'bar'}, 2764800))
+
         # test parse invalid backend
         config = {'url': 'https://localhost:8200', 'backend': 'invalid'}
         with self.assertRaisesRegex(E2j2Exception, 'Unknown K/V backend'):
             _ = vault_tag.parse(config, 'kv2/secret')
 
     def test_dns(self):
+        dns_tag.resolvers.clear()
         resolver = Resolver()
 
         class Reply:
@@ -313,9 +439,107 @@ class TestParsers(unittest.TestCase):
             with self.assertRaisesRegex(E2j2Exception, 'error'):
                 dns_tag.parse({}, 'unknown.foo.bar')
 
+        # --tag-timeout limits the lifetime of the query
+        resolver.query = MagicMock(return_value=[])
+        with patch('e2j2.tags.dns_tag.Resolver', return_value=resolver):
+            with patch('e2j2.tags.timeout', 2):
+                dns_tag.parse({}, 'www.foo.bar')
+                resolver.query.assert_called_with('www.foo.bar', rdtype='A', lifetime=2)
+        dns_tag.resolvers.clear()
+
+    def test_dns_resolver(self):
+        queries = []
+
+        def answer(sock):
+            # stand-in dns server, www.foo.bar has a TTL of 60 seconds and ttl0.foo.bar isn't cached
+            while True:
+                try:
+                    data, address = sock.recvfrom(512)
+                except OSError:
+                    # closed
+                    return
+                query = dns.message.from_wire(data)
+                name = query.question[0].name.to_text()
+                queries.append(name)
+                response = dns.message.make_response(query)
+                response.answer.append(
+                    dns.rrset.from_text(name, 0 if name.startswith('ttl0') else 60, 'IN', 'A', '127.0.0.1')
+                )
+                sock.sendto(response.to_wire(), address)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        Thread(target=answer, args=(sock,), daemon=True).start()
+        tag_config = {'nameservers': ['127.0.0.1'], 'port': sock.getsockname()[1]}
+
+        try:
+            dns_tag.resolvers.clear()
+            with patch('e2j2.tags.dns_tag.Resolver', wraps=Resolver) as resolver_mock:
+                # answers are cached until the TTL expires
+                values, ttl = dns_tag.parse_with_ttl(tag_config, 'www.foo.bar')
+                self.assertEqual(values, [{'address': '127.0.0.1'}])
+                self.assertTrue(55 <= ttl <= 60)
+                self.assertEqual(dns_tag.parse(dict(tag_config), 'www.foo.bar'), [{'address': '127.0.0.1'}])
+                self.assertEqual(queries, ['www.foo.bar.'])
+
+                dns_tag.parse(tag_config, 'ttl0.foo.bar')
+                self.assertEqual(dns_tag.parse_with_ttl(tag_config, 'ttl0.foo.bar')[1], 0)
+                self.assertEqual(queries, ['www.foo.bar.', 'ttl0.foo.bar.', 'ttl0.foo.bar.'])
+
+                # one resolver per nameservers and port
+                self.assertEqual(resolver_mock.call_count, 1)
+                self.assertIs(dns_tag.get_resolver(tag_config), dns_tag.get_resolver(dict(tag_config)))
+                self.assertIsNot(dns_tag.get_resolver(tag_config), dns_tag.get_resolver({'port': 5353}))
+        finally:
+            sock.close()
+            dns_tag.resolvers.clear()
+
     def test_escape(self):
         self.assertEqual(escape_tag.parse('file://foobar'), 'file://foobar')
 
 
+    def test_registry(self):
+        plugin = MagicMock()
+        entry_point = MagicMock()
+        entry_point.name = 'foo'
+        entry_point.load.return_value = plugin
+        builtin = MagicMock()
+        builtin.name = 'json'
+
+        try:
+            tags.plugins = None
+            tags.loaded_plugins = {}
+            with patch('importlib.metadata.entry_points', return_value=[entry_point, builtin]) as entry_points_mock:
+                # builtin tags don't need the entry points
+                self.assertTrue(tags.is_tag('json:'))
+                self.assertEqual(entry_points_mock.call_count, 0)
+
+                # neither do values which can't be tags
+                for tag in ['/usr/local/bin:', '10.0.0.1:', 'C:\\Windows:', ':']:
+                    self.assertFalse(tags.is_tag(tag))
+                    self.assertFalse(tags.is_plugin(tag))
+                self.assertEqual(entry_points_mock.call_count, 0)
+                self.assertIs(tags.get_module('json:'), json_tag)
+                self.assertFalse(tags.takes_config('json:'))
+                self.assertTrue(tags.takes_config('vault:'))
+
+                # plugins are registered by entry point name, builtin tags can't be replaced
+                self.assertTrue(tags.is_tag('foo:'))
+                self.assertTrue(tags.is_plugin('foo:'))
+                self.assertFalse(tags.is_plugin('json:'))
+                self.assertFalse(tags.is_tag('bar:'))
+                self.assertTrue(tags.takes_config('foo:'))
+                entry_points_mock.assert_called_once_with(group='e2j2.tags')
+
+                # plugins are loaded once
+                self.assertIs(tags.get_module('foo:'), plugin)
+                self.assertIs(tags.get_module('foo:'), plugin)
+                self.assertEqual(entry_point.load.call_count, 1)
+                self.assertEqual(builtin.load.call_count, 0)
+        finally:
+            tags.plugins = None
+            tags.loaded_plugins = {}
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,14 @@
+import itertools
+import os
+import threading
+import types
 import unittest
-from mock import patch, MagicMock
+from tempfile import TemporaryDirectory
+from mock import patch, MagicMock, ANY
 from callee import Contains
-from e2j2 import templates
+from e2j2 import schemas, templates, tags
+from e2j2.constants import TAGS
+from e2j2.tags import file_tag
 from e2j2.exceptions import E2j2Exception
 from jinja2.exceptions import UndefinedError, FilterArgumentError, TemplateSyntaxError
 
@@ -22,15 +29,54 @@ class TestTemplates(unittest.TestCase):
         pass
 
     def test_find(self):
-        # recurse = True
-        with patch('e2j2.templates.os.walk') as recurse_mock:
-            templates.find(searchlist=['/etc'], j2file_ext='.j2', recurse=True)
-            recurse_mock.assert_called_with('/etc', followlinks=True)
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            for path in ['a.j2', 'b.txt', 'sub/c.j2', 'sub/deeper/d.j2', 'skip/e.j2', 'sub/f.j2.bak']:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, path)), exist_ok=True)
+                with open(os.path.join(tmpdir, path), 'w') as fh:
+                    fh.write('')
+            # symlink loop and duplicate template
+            os.symlink(tmpdir, os.path.join(tmpdir, 'sub', 'loop'))
+            os.symlink(os.path.join(tmpdir, 'a.j2'), os.path.join(tmpdir, 'sub', 'link.j2'))
+
+            def expected(*paths):
+                return sorted(os.path.join(tmpdir, path) for path in paths)
+
+            # recurse = False
+            j2files = templates.find(searchlist=[tmpdir], j2file_ext='.j2', recurse=False)
+            self.assertEqual(list(j2files), expected('a.j2'))
+
+            # recurse = True, the result is a lazy stream
+            j2files = templates.find(searchlist=[tmpdir], j2file_ext='.j2', recurse=True)
+            self.assertIsInstance(j2files, types.GeneratorType)
+            self.assertEqual(sorted(j2files), expected('a.j2', 'sub/c.j2', 'sub/deeper/d.j2', 'skip/e.j2'))
+
+            # exclude and max depth
+            self.assertEqual(
+                sorted(templates.find(searchlist=[tmpdir], j2file_ext='.j2', recurse=True, exclude=['skip', 'c.*'])),
+                expected('a.j2', 'sub/deeper/d.j2'),
+            )
+            self.assertEqual(
+                sorted(templates.find(searchlist=[tmpdir], j2file_ext='.j2', recurse=True, max_depth=1)),
+                expected('a.j2', 'sub/c.j2', 'skip/e.j2'),
+            )
+
+            # overlapping search list
+            self.assertEqual(
+                sorted(templates.find(searchlist=[tmpdir, os.path.join(tmpdir, 'sub')], j2file_ext='.j2')),
+                expected('a.j2', 'sub/c.j2'),
+            )
 
-        # recurse = False
-        with patch('e2j2.templates.os.listdir') as dirlist_mock:
-            templates.find(searchlist=['/etc'], j2file_ext='.j2', recurse=False)
-            dirlist_mock.assert_called_with('/etc')
+            # missing search list items are skipped and reported to onerror
+            missing = os.path.join(tmpdir, 'missing')
+            self.assertEqual(list(templates.find(searchlist=[missing], j2file_ext='.j2')), [])
+            onerror = MagicMock()
+            self.assertEqual(
+                list(templates.find(searchlist=[missing, tmpdir], j2file_ext='.j2', onerror=onerror)),
+                [os.path.join(tmpdir, 'a.j2')],
+            )
+            self.assertIsInstance(onerror.call_args[0][0], FileNotFoundError)
+            self.assertEqual(onerror.call_args[0][0].filename, missing)
 
     def test_recursive_iter(self):
         # flat dict
@@ -57,6 +103,46 @@ class TestTemplates(unittest.TestCase):
                 # whitelist / blacklist
                 self.assertEqual(templates.get_vars(config, whitelist=['FOO_ENV'], blacklist=['FOO_ENV']), {})
 
+        # only referenced tagged variables are resolved
+        config = {'no_color': True, 'twopass': False, 'nested_tags': False, 'stacktrace': False}
+        config.update(markers)
+        config.update({'marker_set': '{{', 'autodetect_marker_set': False})
+        env_vars = {
+            'PLAIN': 'plain',
+            'USED': 'json:{"key": "value"}',
+            'UNUSED': 'consul:foo/bar',
+            'FLATTEN': 'json:config={"flatten": true}:{"flat": "value"}',
+            'CONFIG_FLATTEN': 'vault:secret/bar',
+            'VAULT_CONFIG': '{"flatten": true}',
+        }
+        with patch.dict('e2j2.templates.os.environ', env_vars, clear=True):
+            with patch('e2j2.tags.vault_tag.parse', return_value={'bar': 'baz'}) as vault_mock:
+                self.assertEqual(
+                    templates.get_vars(config, whitelist=list(env_vars), blacklist=['VAULT_CONFIG'], names={'USED'}),
+                    {
+                        'PLAIN': 'plain',
+                        'USED': {'key': 'value'},
+                        'FLATTEN': {'flat': 'value'},
+                        'flat': 'value',
+                        'CONFIG_FLATTEN': {'bar': 'baz'},
+                        'bar': 'baz',
+                    },
+                )
+                vault_mock.assert_called_once_with({'flatten': True}, 'secret/bar')
+
+        # referenced variables of all templates
+        environments = templates.EnvironmentPool()
+        with TemporaryDirectory() as tmpdir:
+            j2files = [os.path.join(tmpdir, 'file%s.j2' % idx) for idx in range(2)]
+            for j2file, content in zip(j2files, ['{{ FOO }}', '{% for x in BAR %}{{ x }}{% endfor %}']):
+                with open(j2file, 'w') as fh:
+                    fh.write(content)
+            self.assertEqual(templates.referenced_variables(config, j2files, environments), {'FOO', 'BAR'})
+
+            with open(j2files[0], 'w') as fh:
+                fh.write('{% include FOO %}')
+            self.assertIsNone(templates.referenced_variables(config, j2files, environments))
+
     def test_resolv_vars(self):
         config = {'no_color': True, 'nested_tags': False}
 
@@ -87,7 +173,7 @@ class TestTemplates(unittest.TestCase):
 
             # test string with nested file tag raising an error
             with patch(
-                'e2j2.templates.file_tag.parse',
+                'e2j2.tags.file_tag.parse',
                 side_effect=E2j2Exception('IOError raised while reading file: /foobar.txt'),
             ):
                 with patch('e2j2.templates.write') as display_mock:
@@ -134,17 +220,188 @@ class TestTemplates(unittest.TestCase):
                 )
             )
 
+    def test_tag_cache(self):
+        config = {
+            'no_color': True,
+            'nested_tags': False,
+            'tag_cache_ttl': 60,
+            'stacktrace': False,
+            'marker_set': '{{',
+            'autodetect_marker_set': False,
+        }
+        config.update(markers)
+        templates.tag_cache.clear()
+
+        # identical tags are resolved once
+        with patch('e2j2.tags.vault_tag.parse_with_ttl', return_value=({'foo': 'bar'}, None)) as vault_mock:
+            varcontext = templates.resolv_vars(
+                config, var_list=['A', 'B'], env_vars={'A': 'vault:secret/foo', 'B': 'vault:secret/foo'}
+            )
+            self.assertEqual(varcontext, {'A': {'foo': 'bar'}, 'B': {'foo': 'bar'}})
+            self.assertEqual(vault_mock.call_count, 1)
+            self.assertIsNot(varcontext['A'], varcontext['B'])
+
+            # different tag config
+            templates.parse_tag(config, 'vault:', 'vault:config={"backend": "kv2"}:secret/foo')
+            self.assertEqual(vault_mock.call_count, 2)
+
+        # the lease duration limits the ttl
+        with patch('e2j2.tags.vault_tag.parse_with_ttl', return_value=('secret', 10)):
+            with patch('e2j2.templates.tag_cache.set') as set_mock:
+                templates.parse_tag(config, 'vault:', 'secret/bar')
+                self.assertEqual(set_mock.call_args[0][1:], ('secret', 10))
+
+        # changed files are read again
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'file.txt')
+            with open(filename, 'w') as fh:
+                fh.write('foo')
+            self.assertEqual(templates.parse_tag(config, 'file:', filename)[1], 'foo')
+            with open(filename, 'w') as fh:
+                fh.write('foobar')
+            self.assertEqual(templates.parse_tag(config, 'file:', filename)[1], 'foobar')
+            self.assertEqual(templates.parse_tag(config, 'file:', filename)[1], 'foobar')
+
+        self.assertEqual((templates.tag_cache.hits, templates.tag_cache.misses), (2, 5))
+
+        # cache disabled
+        config['tag_cache_ttl'] = 0
+        with patch('e2j2.tags.vault_tag.parse', return_value='secret') as vault_mock:
+            templates.parse_tag(config, 'vault:', 'secret/foo')
+            templates.parse_tag(config, 'vault:', 'secret/foo')
+            self.assertEqual(vault_mock.call_count, 2)
+        templates.tag_cache.clear()
+
+    def test_resolv_remote_vars(self):
+        config = {'no_color': True, 'nested_tags': False, 'tag_concurrency': 4, 'tag_timeout': 0}
+        env_vars = {
+            'FOO_ENV': 'plain',
+            'VAULT1_ENV': 'vault:secret/one',
+            'VAULT2_ENV': 'vault:secret/two',
+            'DNS_ENV': 'dns:www.foo.bar',
+        }
+        threads = set()
+        daemon = set()
+        barrier = threading.Barrier(3, timeout=10)
+
+        def parse_tag(_, tag, value, prefetched=None):
+            threads.add(threading.get_ident())
+            daemon.add(threading.current_thread().daemon)
+            # all lookups have to run at the same time to pass the barrier
+            barrier.wait()
+            if value == 'dns:www.foo.bar':
+                raise E2j2Exception('dns error')
+            return {}, value
+
+        # remote tags are resolved concurrently
+        with patch('e2j2.templates.parse_tag', side_effect=parse_tag) as parse_mock:
+            with patch('e2j2.templates.write') as display_mock:
+                varcontext = templates.resolv_vars(config, var_list=list(env_vars), env_vars=env_vars)
+                self.assertEqual(parse_mock.call_count, 3)
+                self.assertEqual(len(threads), 3)
+                # lookups which time out don't block the exit
+                self.assertEqual(daemon, {True})
+                self.assertEqual(list(varcontext), ['FOO_ENV', 'VAULT1_ENV', 'VAULT2_ENV'])
+                display_mock.assert_called_with(Contains('parsing DNS_ENV failed with error: dns error'))
+
+        # lookup timeout
+        config['tag_timeout'] = 0.01
+        release = threading.Event()
+        with patch('e2j2.templates.parse_tag', side_effect=lambda *args: release.wait(10)):
+            with patch('e2j2.templates.write') as display_mock:
+                varcontext = templates.resolv_vars(config, var_list=['VAULT1_ENV'], env_vars=env_vars)
+                self.assertEqual(varcontext, {})
+                display_mock.assert_called_with(Contains('lookup timed out after 0.01 seconds'))
+
+        # the timeout is shared by all lookups, the remaining lookups don't wait again
+        config.update({'tag_timeout': 5, 'tag_concurrency': 2})
+        hung = {'VAULT%d_ENV' % i: 'vault:secret/%d' % i for i in range(6)}
+        with patch('e2j2.templates.parse_tag', side_effect=lambda *args: release.wait(10)):
+            with patch('e2j2.templates.monotonic', side_effect=itertools.chain([0], itertools.repeat(5))):
+                with patch('e2j2.templates.write') as display_mock:
+                    self.assertEqual(templates.resolv_vars(config, var_list=list(hung), env_vars=hung), {})
+                    self.assertEqual(display_mock.call_count, 6)
+                    display_mock.assert_called_with(Contains('lookup timed out after 5 seconds'))
+        release.set()
+
+        # concurrency disabled
+        config.update({'tag_concurrency': 1, 'tag_timeout': 0})
+        threads.clear()
+        with patch('e2j2.templates.parse_tag', side_effect=lambda *args: threads.add(threading.get_ident()) or ({}, '')):
+            with patch('e2j2.templates.write'):
+                templates.resolv_vars(config, var_list=['VAULT1_ENV', 'VAULT2_ENV'], env_vars=env_vars)
+                self.assertEqual(threads, {threading.get_ident()})
+
+    def test_prefetch_consul_keys(self):
+        config = {
+            'no_color': True,
+            'nested_tags': False,
+            'stacktrace': False,
+            'marker_set': '{{',
+            'autodetect_marker_set': False,
+        }
+        config.update(markers)
+        env_vars = {'DB': 'consul:app/db', 'CACHE': 'consul:app/cache', 'FOO': 'json:{}'}
+        prefetched = {'DB': [{'Key': 'app/db', 'Value': b'db'}], 'CACHE': [{'Key': 'app/cache', 'Value': b'cache'}]}
+
+        with patch('e2j2.tags.consul_tag.prefetch', return_value=prefetched) as prefetch_mock:
+            with patch('e2j2.tags.consul_tag.ConsulKV.get') as get_mock:
+                varcontext = templates.resolv_vars(config, var_list=['DB', 'CACHE', 'FOO'], env_vars=env_vars)
+                prefetch_mock.assert_called_with({'DB': ({}, 'app/db'), 'CACHE': ({}, 'app/cache')})
+                self.assertEqual(get_mock.call_count, 0)
+                self.assertEqual(varcontext, {'DB': 'db', 'CACHE': 'cache', 'FOO': {}})
+
+            # no prefetch for a single consul variable
+            prefetch_mock.reset_mock()
+            with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=prefetched['DB']):
+                varcontext = templates.resolv_vars(config, var_list=['DB', 'FOO'], env_vars=env_vars)
+                self.assertEqual(prefetch_mock.call_count, 0)
+                self.assertEqual(varcontext, {'DB': 'db', 'FOO': {}})
+
+            # cached variables aren't prefetched
+            config['tag_cache_ttl'] = 60
+            templates.tag_cache.clear()
+            prefetch_mock.reset_mock()
+            with patch('e2j2.tags.consul_tag.ConsulKV.get') as get_mock:
+                templates.resolv_vars(config, var_list=['DB', 'CACHE'], env_vars=env_vars)
+                self.assertEqual(prefetch_mock.call_count, 1)
+                for _ in range(2):
+                    varcontext = templates.resolv_vars(config, var_list=['DB', 'CACHE'], env_vars=env_vars)
+                    self.assertEqual(varcontext, {'DB': 'db', 'CACHE': 'cache'})
+                self.assertEqual(prefetch_mock.call_count, 1)
+                self.assertEqual(get_mock.call_count, 0)
+                self.assertEqual(templates.tag_cache.hits, 4)
+
+            # a single uncached variable is read without prefetch
+            templates.tag_cache.entries.pop(next(iter(templates.tag_cache.entries)))
+            with patch('e2j2.tags.consul_tag.ConsulKV.get', return_value=prefetched['DB']) as get_mock:
+                varcontext = templates.resolv_vars(config, var_list=['DB', 'CACHE'], env_vars=env_vars)
+                self.assertEqual(varcontext, {'DB': 'db', 'CACHE': 'cache'})
+                self.assertEqual(prefetch_mock.call_count, 1)
+                self.assertEqual(get_mock.call_count, 1)
+            templates.tag_cache.clear()
+
+        # a hung prefetch is bounded by the tag timeout, the keys are read one by one instead
+        config.update({'tag_cache_ttl': 0, 'tag_timeout': 0.2, 'tag_concurrency': 2})
+        release = threading.Event()
+        with patch('e2j2.tags.consul_tag.prefetch', side_effect=lambda lookups: release.wait(10)):
+            with patch('e2j2.tags.consul_tag.ConsulKV.get', side_effect=lambda key, recurse: prefetched[key.upper()[4:]]):
+                varcontext = templates.resolv_vars(config, var_list=['DB', 'CACHE'], env_vars=env_vars)
+                self.assertEqual(varcontext, {'DB': 'db', 'CACHE': 'cache'})
+        release.set()
+
     def test_render(self):
         config = {'no_color': True, 'twopass': False}
         with patch('e2j2.templates.detect_markers', return_value=markers):
-            with patch('e2j2.templates.jinja2.Environment') as jinja2_mock:
+            with patch('jinja2.Environment') as jinja2_mock:
                 with patch('builtins.open') as file_mock:
                     # one pass
-                    jinja2_mock.return_value.from_string.return_value.render.return_value = 'rendered template'
+                    jinja2_mock.return_value.get_template.return_value.render.return_value = 'rendered template'
                     response = templates.render(config=config, j2file='/foo/file1.j2', j2vars={"FOO": "BAR"})
 
                     file_mock.assert_called_with('/foo/file1.j2', 'r')
-                    jinja2_mock.return_value.from_string.return_value.render.assert_called_with({"FOO": "BAR"})
+                    jinja2_mock.return_value.get_template.assert_called_with('file1.j2')
+                    jinja2_mock.return_value.get_template.return_value.render.assert_called_with({"FOO": "BAR"})
                     self.assertEqual(response, 'rendered template')
 
                     # two pass
@@ -174,9 +431,9 @@ class TestTemplates(unittest.TestCase):
             ]
             for exception in exceptions:
                 template.render = MagicMock(side_effect=exception)
-                j2.from_string = MagicMock(return_value=template)
+                j2.get_template = MagicMock(return_value=template)
                 with patch('builtins.open'):
-                    with patch('e2j2.templates.jinja2.Environment', return_value=j2):
+                    with patch('jinja2.Environment', return_value=j2):
                         with self.assertRaisesRegex(E2j2Exception, 'at line'):
                             _ = templates.render(config=config, j2file='/foo/file1.j2', j2vars={"FOO": "BAR"})
 
@@ -184,17 +441,153 @@ class TestTemplates(unittest.TestCase):
             template.render = MagicMock(side_effect=FileNotFoundError())
             j2.get_template = MagicMock(return_value=template)
             with patch('builtins.open'):
-                with patch('e2j2.templates.jinja2.Environment', return_value=j2):
+                with patch('jinja2.Environment', return_value=j2):
                     with self.assertRaisesRegex(E2j2Exception, 'Template file1.j2 not found'):
                         _ = templates.render(config=config, j2file='/foo/file1.j2', j2vars={"FOO": "BAR"})
 
                 # other exceptions
                 template.render = MagicMock(side_effect=ValueError('Error'))
                 j2.get_template = MagicMock(return_value=template)
-                with patch('e2j2.templates.jinja2.Environment', return_value=j2):
+                with patch('jinja2.Environment', return_value=j2):
                     with self.assertRaisesRegex(E2j2Exception, 'Error'):
                         _ = templates.render(config=config, j2file='/foo/file1.j2', j2vars={"FOO": "BAR"})
 
+    def test_stream(self):
+        config = {'twopass': False}
+        with patch('e2j2.templates.detect_markers', return_value=markers):
+            with TemporaryDirectory() as tmpdir:
+                j2file = os.path.join(tmpdir, 'file1.j2')
+                with open(j2file, 'w') as fh:
+                    fh.write('{% for item in LIST %}{{ item }}\n{% endfor %}{{ END }}')
+
+                # output is generated in chunks
+                j2vars = {'LIST': ['a', 'b', 'c'], 'END': 'end'}
+                chunks = list(templates.stream(config, j2file, j2vars))
+                self.assertGreater(len(chunks), 1)
+                self.assertEqual(''.join(chunks), templates.render(config, j2file, j2vars))
+
+                # errors are raised while the output is consumed
+                chunks = templates.stream(config, j2file, {'LIST': ['a', 'b']})
+                self.assertEqual(next(chunks), 'a')
+                with self.assertRaisesRegex(E2j2Exception, 'at line'):
+                    list(chunks)
+
+                with self.assertRaisesRegex(E2j2Exception, 'Template file2.j2 not found'):
+                    list(templates.stream(config, os.path.join(tmpdir, 'file2.j2'), {}))
+
+    def test_lazy_vars(self):
+        config = {'no_color': True, 'twopass': False, 'nested_tags': False, 'stacktrace': False}
+        config.update(markers)
+        config.update({'marker_set': '{{', 'autodetect_marker_set': False})
+        env_vars = {'PLAIN': 'plain', 'FOO': 'vault:secret/foo', 'BAR': 'vault:secret/bar', 'BAZ': 'vault:secret/baz'}
+
+        with patch('e2j2.tags.vault_tag.parse', side_effect=['foo', E2j2Exception('failed')]) as vault_mock:
+            with patch('e2j2.templates.write') as write_mock:
+                j2vars = templates.LazyVars(config, ['PLAIN', 'FOO', 'BAR', 'BAZ'], env_vars)
+                self.assertEqual(vault_mock.call_count, 0)
+                self.assertEqual(j2vars['PLAIN'], 'plain')
+
+                # tagged variables are resolved on first lookup
+                self.assertEqual(j2vars['FOO'], 'foo')
+                self.assertEqual(j2vars['FOO'], 'foo')
+                vault_mock.assert_called_once_with({}, 'secret/foo')
+
+                # failed lookups are reported once
+                self.assertNotIn('BAR', j2vars)
+                self.assertNotIn('BAR', j2vars)
+                write_mock.assert_called_once_with(Contains('parsing BAR failed with error: failed'))
+                self.assertEqual(vault_mock.call_count, 2)
+
+        # rendering only resolves the used variables
+        with TemporaryDirectory() as tmpdir:
+            j2file = os.path.join(tmpdir, 'file1.j2')
+            with open(os.path.join(tmpdir, 'include.j2'), 'w') as fh:
+                fh.write('{{ PLAIN }}')
+            with open(j2file, 'w') as fh:
+                fh.write('{% for x in range(2) %}{{ FOO }}{% endfor %} {% include "include.j2" %}\n{{ BAR }}')
+
+            def vault_parse(tag_config, value):
+                return value.split('/')[-1]
+
+            with patch('e2j2.tags.vault_tag.parse', side_effect=vault_parse) as vault_mock:
+                j2vars = templates.LazyVars(config, ['PLAIN', 'FOO', 'BAR', 'BAZ'], env_vars)
+                self.assertEqual(templates.render(config, j2file, j2vars), 'foofoo plain\nbar')
+                self.assertEqual(''.join(templates.stream(config, j2file, j2vars)), 'foofoo plain\nbar')
+                self.assertEqual(vault_mock.call_count, 2)
+
+                # errors are reported with the line number
+                with patch('e2j2.templates.write'):
+                    j2vars = templates.LazyVars(config, ['PLAIN', 'FOO'], env_vars)
+                    with self.assertRaisesRegex(E2j2Exception, "'BAR' is undefined at line: 2"):
+                        templates.render(config, j2file, j2vars)
+
+                    # all variables are resolved when the mapping is copied
+                    vault_mock.side_effect = ['foo', E2j2Exception('failed'), 'baz']
+                    vault_mock.reset_mock()
+                    with patch.dict('e2j2.templates.os.environ', env_vars):
+                        j2vars = templates.get_vars(config, ['PLAIN', 'FOO', 'BAR', 'BAZ'], [], lazy=True)
+                    self.assertEqual(dict(j2vars), {'PLAIN': 'plain', 'FOO': 'foo', 'BAZ': 'baz'})
+                    self.assertEqual(vault_mock.call_count, 3)
+
+                # the variables used by the templates are known, they're resolved together
+                vault_mock.side_effect = vault_parse
+                vault_mock.reset_mock()
+                with patch.dict('e2j2.templates.os.environ', env_vars):
+                    with patch('e2j2.templates.resolv_vars', wraps=templates.resolv_vars) as resolv_mock:
+                        j2vars = templates.get_vars(
+                            config, ['PLAIN', 'FOO', 'BAR', 'BAZ'], [], names={'FOO', 'BAR'}, lazy=True
+                        )
+                        resolv_mock.assert_called_once_with(config, ['PLAIN', 'FOO', 'BAR'], ANY)
+                self.assertEqual(j2vars, {'PLAIN': 'plain', 'FOO': 'foo', 'BAR': 'bar'})
+                self.assertEqual(vault_mock.call_count, 2)
+
+    def test_environment_pool(self):
+        environments = templates.EnvironmentPool()
+
+        # environments are shared per search path and marker set
+        j2 = environments.get(markers, '/foo')
+        self.assertIs(j2, environments.get(markers, '/foo'))
+        self.assertIsNot(j2, environments.get(markers, '/bar'))
+        self.assertEqual(j2.variable_start_string, '{{')
+
+        alternative_markers = markers.copy()
+        alternative_markers.update({'variable_start': '(=', 'variable_end': '=)'})
+        j2 = environments.get(alternative_markers, '/foo')
+        self.assertIsNot(j2, environments.get(markers, '/foo'))
+        self.assertEqual(j2.variable_start_string, '(=')
+        self.assertEqual(len(environments.environments), 3)
+
+    def test_find_variables(self):
+        config = {'twopass': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+        config.update(markers)
+        environments = templates.EnvironmentPool()
+
+        with TemporaryDirectory() as tmpdir:
+            j2file = os.path.join(tmpdir, 'file1.j2')
+            with open(j2file, 'w') as fh:
+                fh.write('{% set LOCAL = 1 %}{{ FOO.bar }} {% include "include.j2" %}{% for x in LIST %}{{ x }}{% endfor %}')
+            with open(os.path.join(tmpdir, 'include.j2'), 'w') as fh:
+                fh.write('{{ BAR }}{% include "file1.j2" %}')
+
+            # variables of the template and its includes
+            self.assertEqual(templates.find_variables(config, j2file, environments), {'FOO', 'BAR', 'LIST'})
+
+            # dynamic include
+            with open(j2file, 'w') as fh:
+                fh.write('{% include FOO %}')
+            self.assertIsNone(templates.find_variables(config, j2file, environments))
+
+            # syntax error
+            with open(j2file, 'w') as fh:
+                fh.write('{{ FOO ')
+            self.assertIsNone(templates.find_variables(config, j2file, environments))
+
+            # two pass rendering
+            config['twopass'] = True
+            with open(j2file, 'w') as fh:
+                fh.write('{{ FOO }}')
+            self.assertIsNone(templates.find_variables(config, j2file, environments))
+
     def test_parse_tag(self):
         config = {
             'stacktrace': True,
@@ -206,41 +599,41 @@ class TestTemplates(unittest.TestCase):
         }
         config.update(markers)
 
-        with patch('e2j2.templates.json_tag.parse') as json_mock:
+        with patch('e2j2.tags.json_tag.parse') as json_mock:
             templates.parse_tag(config, 'json:', '{}')
             json_mock.assert_called_with('{}')
 
-        with patch('e2j2.templates.jsonfile_tag.parse') as jsonfile_mock:
+        with patch('e2j2.tags.jsonfile_tag.parse') as jsonfile_mock:
             templates.parse_tag(config, 'jsonfile:', 'file.json')
             jsonfile_mock.assert_called_with('file.json')
 
-        with patch('e2j2.templates.base64_tag.parse') as base64_mock:
+        with patch('e2j2.tags.base64_tag.parse') as base64_mock:
             templates.parse_tag(config, 'base64:', 'Zm9vYmFy')
             base64_mock.assert_called_with('Zm9vYmFy')
 
-        with patch('e2j2.templates.consul_tag.parse') as consul_mock:
+        with patch('e2j2.tags.consul_tag.parse') as consul_mock:
             templates.parse_tag(config, 'consul:', 'consulkey')
             consul_mock.assert_called_with({}, 'consulkey')
 
-        with patch('e2j2.templates.list_tag.parse') as list_mock:
+        with patch('e2j2.tags.list_tag.parse') as list_mock:
             templates.parse_tag(config, 'list:', 'foo,bar')
             list_mock.assert_called_with('foo,bar')
 
-        with patch('e2j2.templates.file_tag.parse') as file_mock:
+        with patch('e2j2.tags.file_tag.parse') as file_mock:
             templates.parse_tag(config, 'file:', 'file.txt')
             file_mock.assert_called_with('file.txt')
 
         # no config
-        with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+        with patch('e2j2.tags.vault_tag.parse') as vault_mock:
             templates.parse_tag(config, 'vault:', 'secret/mysecret')
             vault_mock.assert_called_with({}, 'secret/mysecret')
 
-        with patch('e2j2.templates.escape_tag.parse') as escape_mock:
+        with patch('e2j2.tags.escape_tag.parse') as escape_mock:
             templates.parse_tag(config, 'escape:', 'file:foobar')
             escape_mock.assert_called_with('file:foobar')
 
         # with config
-        with patch('e2j2.templates.json_tag.parse') as json_mock:
+        with patch('e2j2.tags.json_tag.parse') as json_mock:
             templates.parse_tag(
                 config, 'json:', 'json:config={"flatten": true}:{"key": {"nested": "flattened json example"}}'
             )
@@ -249,7 +642,7 @@ class TestTemplates(unittest.TestCase):
         # with config and alternative marker [, ]
         config['config_start'] = '['
         config['config_end'] = ']'
-        with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+        with patch('e2j2.tags.vault_tag.parse') as vault_mock:
             templates.parse_tag(config, 'vault:', 'config=["url": "https://localhost:8200"]:secret/mysecret')
             vault_mock.assert_called_with({"url": "https://localhost:8200"}, 'secret/mysecret')
 
@@ -258,7 +651,7 @@ class TestTemplates(unittest.TestCase):
         config['marker_set'] = '{{'
         config['config_start'] = None
         config['config_end'] = None
-        with patch('e2j2.templates.vault_tag.parse'):
+        with patch('e2j2.tags.vault_tag.parse'):
             with self.assertRaisesRegex(E2j2Exception, 'invalid config markers used'):
                 templates.parse_tag(config, 'vault:', 'config=["url": "https://localhost:8200"]:secret/mysecret')
 
@@ -266,7 +659,7 @@ class TestTemplates(unittest.TestCase):
         # with config and alternative marker <, >
         config['config_start'] = '<'
         config['config_end'] = '>'
-        with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+        with patch('e2j2.tags.vault_tag.parse') as vault_mock:
             templates.parse_tag(
                 config, 'vault:', 'config=<"url": "https://localhost:8200", "token": "aabbccddee">:secret/mysecret'
             )
@@ -275,7 +668,7 @@ class TestTemplates(unittest.TestCase):
         # with config and alternative marker (, )
         config['config_start'] = '('
         config['config_end'] = ')'
-        with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+        with patch('e2j2.tags.vault_tag.parse') as vault_mock:
             templates.parse_tag(config, 'vault:', 'config=("url": "https://localhost:8200"):secret/mysecret')
             vault_mock.assert_called_with({"url": "https://localhost:8200"}, 'secret/mysecret')
 
@@ -285,14 +678,14 @@ class TestTemplates(unittest.TestCase):
         # with envar config
         with patch('e2j2.templates.os') as os_mock:
             os_mock.environ = {'VAULT_CONFIG': '{"url": "https://localhost:8200"}'}
-            with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+            with patch('e2j2.tags.vault_tag.parse') as vault_mock:
                 templates.parse_tag(config, 'vault:', 'secret/mysecret')
                 vault_mock.assert_called_with({"url": "https://localhost:8200"}, 'secret/mysecret')
 
         # with envvar config and token envvar
         with patch('e2j2.templates.os') as os_mock:
             os_mock.environ = {'VAULT_CONFIG': '{"url": "https://localhost:8200"}', 'VAULT_TOKEN': 'aabbccddee'}
-            with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+            with patch('e2j2.tags.vault_tag.parse') as vault_mock:
                 templates.parse_tag(config, 'vault:', 'secret/mysecret')
                 vault_mock.assert_called_with(
                     {'url': 'https://localhost:8200', 'token': 'aabbccddee'}, 'secret/mysecret'
@@ -302,8 +695,8 @@ class TestTemplates(unittest.TestCase):
         config['marker_set'] = '{{'
         config['config_start'] = None
         config['config_end'] = None
-        with patch('e2j2.templates.file_tag.parse', return_value='aabbccddee') as file_mock:
-            with patch('e2j2.templates.vault_tag.parse') as vault_mock:
+        with patch('e2j2.tags.file_tag.parse', return_value='aabbccddee') as file_mock:
+            with patch('e2j2.tags.vault_tag.parse') as vault_mock:
                 templates.parse_tag(
                     config,
                     'vault:',
@@ -313,12 +706,12 @@ class TestTemplates(unittest.TestCase):
                     {'url': 'https://localhost:8200', 'token': 'aabbccddee'}, 'secret/mysecret'
                 )
 
-        with patch('e2j2.templates.dns_tag.parse') as dns_mock:
+        with patch('e2j2.tags.dns_tag.parse') as dns_mock:
             templates.parse_tag(config, 'dns:', 'config={"type": "MX"}:mx.foo.bar')
             dns_mock.assert_called_with({'type': 'MX'}, 'mx.foo.bar')
 
         # with config
-        with patch('e2j2.templates.dns_tag.parse') as dns_mock:
+        with patch('e2j2.tags.dns_tag.parse') as dns_mock:
             templates.parse_tag(config, 'dns:', 'www.foo.bar')
             dns_mock.assert_called_with({}, 'www.foo.bar')
 
@@ -343,6 +736,111 @@ class TestTemplates(unittest.TestCase):
             templates.parse_tag(config, 'unknown:', 'foobar'), (None, '** ERROR: tag: unknown: not implemented **')
         )
 
+    def test_base_tag_config(self):
+        config = {'nested_tags': False, 'stacktrace': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+        config.update(markers)
+        templates.base_tag_configs.clear()
+        templates.token_files.clear()
+
+        with TemporaryDirectory() as tmpdir:
+            token_file = os.path.join(tmpdir, 'token')
+            with open(token_file, 'w') as fh:
+                fh.write('aabbccddee\n')
+
+            env = {'VAULT_CONFIG': '{"url": "https://localhost:8200"}', 'VAULT_TOKEN': 'file:' + token_file}
+            with patch.dict('e2j2.templates.os.environ', env, clear=True):
+                with patch('e2j2.tags.file_tag.parse', wraps=file_tag.parse) as file_mock:
+                    with patch('e2j2.schemas.validate', wraps=schemas.validate) as validate_mock:
+                        # the env vars are parsed, the token file is read and the config is validated once
+                        for _ in range(3):
+                            self.assertEqual(
+                                templates.get_tag_config(config, 'vault:', 'secret/foo'),
+                                ({'url': 'https://localhost:8200', 'token': 'aabbccddee'}, 'secret/foo'),
+                            )
+                        self.assertEqual(file_mock.call_count, 1)
+                        self.assertEqual(validate_mock.call_count, 1)
+
+                        # per variable config is merged on top of the env config, and validated
+                        self.assertEqual(
+                            templates.get_tag_config(config, 'vault:', 'config={"backend": "kv2"}:secret/foo'),
+                            ({'url': 'https://localhost:8200', 'token': 'aabbccddee', 'backend': 'kv2'}, 'secret/foo'),
+                        )
+                        self.assertEqual(file_mock.call_count, 1)
+                        self.assertEqual(validate_mock.call_count, 2)
+                        self.assertEqual(
+                            templates.get_tag_config(config, 'vault:', 'secret/foo')[0],
+                            {'url': 'https://localhost:8200', 'token': 'aabbccddee'},
+                        )
+
+                        # a changed token file is read again
+                        with open(token_file, 'w') as fh:
+                            fh.write('ffgghhiijjkk\n')
+                        self.assertEqual(
+                            templates.get_tag_config(config, 'vault:', 'secret/foo')[0]['token'], 'ffgghhiijjkk'
+                        )
+                        self.assertEqual(file_mock.call_count, 2)
+                        self.assertEqual(validate_mock.call_count, 3)
+
+                        # a changed env var is parsed again
+                        os.environ['VAULT_CONFIG'] = '{"url": "https://vault:8200"}'
+                        self.assertEqual(
+                            templates.get_tag_config(config, 'vault:', 'secret/foo')[0],
+                            {'url': 'https://vault:8200', 'token': 'ffgghhiijjkk'},
+                        )
+                        self.assertEqual(file_mock.call_count, 2)
+
+                        os.environ['VAULT_CONFIG'] = '{"invalid": true}'
+                        with self.assertRaisesRegex(E2j2Exception, 'config validation failed'):
+                            templates.get_tag_config(config, 'vault:', 'secret/foo')
+                        with self.assertRaisesRegex(E2j2Exception, 'config validation failed'):
+                            templates.get_tag_config(config, 'vault:', 'secret/foo')
+
+        templates.base_tag_configs.clear()
+        templates.token_files.clear()
+
+    def test_get_tag(self):
+        self.assertEqual(templates.get_tag('json:{}'), 'json:')
+        self.assertEqual(templates.get_tag('jsonfile:/foo.json'), 'jsonfile:')
+        self.assertEqual(templates.get_tag('vault:config={"url": "http://localhost"}:secret'), 'vault:')
+        self.assertEqual(templates.get_tag('file:///foo.txt'), 'file:')
+        self.assertEqual(templates.get_tag('unknown:value'), '')
+
+        # paths and urls don't read the entry points of plugin tags
+        with patch('e2j2.tags.get_plugins', return_value={'http:': MagicMock()}) as plugins_mock:
+            for value in ['http://localhost', '/usr/local/bin:/usr/bin', '10.0.0.1:53']:
+                self.assertEqual(templates.get_tag(value), '')
+            self.assertEqual(plugins_mock.call_count, 0)
+        self.assertEqual(templates.get_tag('json'), '')
+        self.assertEqual(templates.get_tag(''), '')
+        self.assertEqual(sorted(tags.BUILTIN_TAGS), sorted(TAGS))
+
+    def test_plugin_tag(self):
+        config = {'nested_tags': False, 'stacktrace': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+        config.update(markers)
+        plugin = MagicMock()
+        plugin.CONFIG_SCHEMA = {'type': 'object', 'properties': {'url': {'type': 'string'}}}
+        plugin.parse.return_value = 'secret'
+        try:
+            tags.plugins = {'foo:': MagicMock()}
+            tags.loaded_plugins = {'foo:': plugin}
+            self.assertEqual(templates.get_tag('foo:bar'), 'foo:')
+
+            # plugins receive the tag config, including FOO_CONFIG and FOO_TOKEN
+            with patch.dict('e2j2.templates.os.environ', {'FOO_CONFIG': '{"url": "http://localhost"}', 'FOO_TOKEN': 'token'}):
+                self.assertEqual(
+                    templates.parse_tag(config, 'foo:', 'bar'),
+                    ({'url': 'http://localhost', 'token': 'token'}, 'secret')
+                )
+            plugin.parse.assert_called_once_with({'url': 'http://localhost', 'token': 'token'}, 'bar')
+
+            # the plugin schema validates the config
+            with self.assertRaisesRegex(E2j2Exception, 'config validation failed'):
+                templates.parse_tag(config, 'foo:', 'config={"url": 1}:bar')
+        finally:
+            tags.plugins = None
+            tags.loaded_plugins = {}
+            schemas.validators.pop('foo:', None)
+
     def test_detect_markers(self):
         config = {
             'marker_set': '{{',
@@ -412,6 +910,39 @@ class TestTemplates(unittest.TestCase):
         response = templates.detect_markers(config, '(==)')
         self.assertEqual(expected_response, response)
 
+        # the last matching marker set wins, config markers take precedence
+        self.assertEqual(templates.detect_markers(config, '{{ a }} [= b =]')['variable_start'], '[=')
+        self.assertEqual(templates.detect_markers(config, '[= a =] config=<"a": 1>:x')['config_start'], '<')
+        self.assertEqual(templates.detect_markers(config, '{= a =} config=')['variable_start'], '{{')
+
+        # results are memoized per config and content
+        with patch('e2j2.templates.autodetect_marker_set', wraps=templates.autodetect_marker_set) as detect_mock:
+            content = '(= a =) ' * 1000
+            response = templates.detect_markers(config, content)
+            self.assertIs(templates.detect_markers(config, content), response)
+            self.assertEqual(detect_mock.call_count, 1)
+            self.assertEqual(templates.detect_markers(config_overwrite, content)['variable_start'], '{{')
+            self.assertEqual(detect_mock.call_count, 2)
+
+        # the cache is used (and cleared) from the tag lookup threads
+        errors = []
+
+        def detect(thread):
+            try:
+                for i in range(500):
+                    templates.detect_markers(config, '{{ %d-%d }}' % (thread, i))
+            except Exception as err:
+                errors.append(err)
+
+        with patch('e2j2.templates.MARKERS_CACHE_SIZE', 4):
+            threads = [threading.Thread(target=detect, args=(thread,)) for thread in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertLessEqual(len(templates.markers_cache), 4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from mock import patch
+from e2j2 import watchers
+from e2j2.tags import consul_tag, dns_tag
+from tests.test_templates import markers
+
+config = {'nested_tags': False, 'stacktrace': False, 'marker_set': '{{', 'autodetect_marker_set': False}
+config.update(markers)
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_watchers(self):
+        environ = {
+            'PLAIN': 'plain value',
+            'JSON': 'json:{"key": "value"}',
+            'CONSUL': 'consul:app/db',
+            'DNS': 'dns:www.foo.bar',
+            'VAULT': 'vault:secret/mysecret',
+        }
+        with patch.dict('e2j2.watchers.os.environ', environ):
+            with patch('e2j2.watchers.Thread') as thread_mock:
+                # values that can't change
+                self.assertFalse(watchers.Watchers(config, ['PLAIN', 'JSON', 'UNKNOWN']).polling)
+                self.assertEqual(thread_mock.call_count, 0)
+
+                # blocking queries and dns ttl
+                watcher = watchers.Watchers(config, ['CONSUL', 'DNS'])
+                self.assertFalse(watcher.polling)
+                thread_mock.assert_any_call(
+                    target=consul_tag.watch, args=({}, 'app/db', watcher.changed), daemon=True
+                )
+                thread_mock.assert_any_call(
+                    target=dns_tag.watch, args=({}, 'www.foo.bar', watcher.changed), daemon=True
+                )
+
+                # vault and nested tags are polled
+                self.assertTrue(watchers.Watchers(config, ['VAULT']).polling)
+                nested_config = config.copy()
+                nested_config['nested_tags'] = True
+                self.assertTrue(watchers.Watchers(nested_config, ['JSON']).polling)
+
+        # without change notification wait returns after the poll interval
+        with patch.dict('e2j2.watchers.os.environ', environ):
+            watcher = watchers.Watchers(config, ['VAULT'])
+            self.assertFalse(watcher.wait(0.01))
+            watcher.changed.set()
+            self.assertTrue(watcher.wait(0.01))
+            self.assertFalse(watcher.changed.is_set())
+
+    def test_file_watchers(self):
+        with TemporaryDirectory() as tmpdir:
+            file_name = os.path.join(tmpdir, 'file.txt')
+            with open(file_name, 'w') as fh:
+                fh.write('content')
+
+            with patch.dict('e2j2.watchers.os.environ', {'FILE': 'file:' + file_name}):
+                with patch('e2j2.watchers.FILE_POLL_INTERVAL', 0.01):
+                    # inotify
+                    if watchers.INotify:
+                        watcher = watchers.Watchers(config, ['FILE'])
+                        self.assertFalse(watcher.polling)
+                        self.assertFalse(watcher.changed.wait(0.1))
+
+                        with open(file_name, 'w') as fh:
+                            fh.write('changed content')
+                        self.assertTrue(watcher.changed.wait(5))
+
+                    # fallback to stat polling
+                    with patch('e2j2.watchers.INotify', None):
+                        watcher = watchers.Watchers(config, ['FILE'])
+                        self.assertFalse(watcher.polling)
+                        self.assertFalse(watcher.changed.wait(0.1))
+
+                        with open(file_name, 'w') as fh:
+                            fh.write('changed again')
+                        self.assertTrue(watcher.changed.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()